@@ -0,0 +1,353 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def threshold_clouds(w, qcl, w_threshs, qcl_threshs, pairs=False):
+    """Threshold w and qcl for every combination of w_thresh and qcl_thresh in one pass.
+
+    w and qcl must be arrays with the same shape: (time, height, lat, lon).
+    Each field is compared against all of its thresholds in one broadcast comparison, and the
+    two masks are then &'ed together for all combinations at once.
+
+    If pairs is True, w_threshs and qcl_threshs are treated as pairs, and only the pairs
+    (w_threshs[i], qcl_threshs[i]) are used.
+
+    Returns a uint8 mask with shape: (time, height, len(w_threshs), len(qcl_threshs), lat, lon),
+    or (time, height, len(w_threshs), lat, lon) if pairs is True.
+    """
+    w = np.asarray(w)
+    qcl = np.asarray(qcl)
+    assert w.shape == qcl.shape
+    assert w.ndim == 4
+    if pairs:
+        assert len(w_threshs) == len(qcl_threshs)
+
+    # N.B. compare in the dtype of the data (normally float32), as happens when comparing against
+    # a python float - otherwise values very close to a thresh can give a different answer.
+    w_threshs = np.asarray(w_threshs, dtype=w.dtype)
+    qcl_threshs = np.asarray(qcl_threshs, dtype=qcl.dtype)
+
+    # (time, height, w_thresh, lat, lon) and (time, height, qcl_thresh, lat, lon).
+    w_mask = w[:, :, None] > w_threshs[:, None, None]
+    qcl_mask = qcl[:, :, None] > qcl_threshs[:, None, None]
+
+    if pairs:
+        cloud_mask = np.empty(w.shape[:2] + (len(w_threshs),) + w.shape[2:], dtype=np.uint8)
+        np.logical_and(w_mask, qcl_mask, out=cloud_mask)
+    else:
+        cloud_mask = np.empty(w.shape[:2] + (len(w_threshs), len(qcl_threshs)) + w.shape[2:],
+                              dtype=np.uint8)
+        np.logical_and(w_mask[:, :, :, None], qcl_mask[:, :, None], out=cloud_mask)
+    return cloud_mask
+
+
+def is_thresh_pairs_cloud_mask(cloud_mask_cube):
+    """Is cloud_mask_cube made from threshold_pairs (i.e. has a thresh_index dim)?"""
+    return len(cloud_mask_cube.coords('thresh_index')) == 1
+
+
+def cloud_mask_thresh_pairs(cloud_mask_cube):
+    """Get the (w_thresh, qcl_thresh) pair for each thresh_index of cloud_mask_cube.
+
+    For a cloud_mask made from all combinations of w_threshs and qcl_threshs, these are the
+    diagonal, i.e. low/low, med/med, hi/hi. For a cloud_mask made from threshold_pairs they are
+    just the pairs.
+    """
+    w_thresh_coord = cloud_mask_cube.coord('w_thres')
+    qcl_thresh_coord = cloud_mask_cube.coord('qcl_thres')
+    return [(w_thresh_coord.points[thresh_index], qcl_thresh_coord.points[thresh_index])
+            for thresh_index in range(w_thresh_coord.shape[0])]
+
+
+def cloud_mask_thresh_slice(cloud_mask_cube, height_level_index, thresh_index):
+    """Get the (time, lat, lon) cube slice of cloud_mask_cube for one height and thresh_index."""
+    if is_thresh_pairs_cloud_mask(cloud_mask_cube):
+        return cloud_mask_cube[:, height_level_index, thresh_index]
+    else:
+        return cloud_mask_cube[:, height_level_index, thresh_index, thresh_index]
+
+
+def cloud_mask_thresh_data(cloud_mask_cube):
+    """Get cloud_mask data as a bool array with shape: (time, height, thresh_index, lat, lon).
+
+    Only the (w_thresh, qcl_thresh) pairs given by cloud_mask_thresh_pairs are returned.
+    """
+    data = cloud_mask_cube.data
+    if not is_thresh_pairs_cloud_mask(cloud_mask_cube):
+        # Take diagonal of thresh, i.e. low/low, med/med, hi/hi.
+        thresh_indices = np.arange(cloud_mask_cube.coord('w_thres').shape[0])
+        data = data[:, :, thresh_indices, thresh_indices]
+    return np.asarray(data).astype(bool)
+
+
+def _wrap_label_pairs(labels, diagonal):
+    """Find pairs of labels that touch across the periodic boundaries of each (lat, lon) slice.
+
+    labels must be a (time, lat, lon) array, labelled separately in each slice.
+    Returns two 1D arrays, with one entry per pair of different labels that touch.
+    """
+    offsets = (-1, 0, 1) if diagonal else (0,)
+    left, right = labels[:, :, 0], labels[:, :, -1]
+    top, bottom = labels[:, 0, :], labels[:, -1, :]
+
+    labels1, labels2 = [], []
+    for offset in offsets:
+        # np.roll(left, -offset, axis=1)[:, j] == left[:, j + offset], wrapped.
+        labels1.extend([right, bottom])
+        labels2.extend([np.roll(left, -offset, axis=1), np.roll(top, -offset, axis=1)])
+    labels1 = np.concatenate([l.ravel() for l in labels1])
+    labels2 = np.concatenate([l.ravel() for l in labels2])
+
+    touching = (labels1 != 0) & (labels2 != 0) & (labels1 != labels2)
+    return labels1[touching], labels2[touching]
+
+
+def _label_and_join_clds(cld_fields, diagonal, wrap):
+    """Label each slice of a (time, lat, lon) stack, then join clouds across the boundaries.
+
+    Returns the labels (unique over the whole stack), the number of labels, the last label in
+    each slice, and an array that maps each label onto the label of the cloud it is part of.
+    """
+    cld_fields = np.asarray(cld_fields, dtype=bool)
+    assert cld_fields.ndim == 3
+
+    # Only connect cells in the same slice.
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 2 if diagonal else 1)
+    # N.B. labels are unique across the whole stack, and are numbered in the order they are found,
+    # so each slice has a contiguous range of labels.
+    labels, num_labels = ndimage.label(cld_fields, structure=structure)
+    slice_last_labels = np.maximum.accumulate(labels.reshape(labels.shape[0], -1).max(axis=1))
+
+    # Maps each label onto the label of the cloud that it is part of.
+    cloud_labels = np.arange(num_labels + 1)
+    if wrap:
+        labels1, labels2 = _wrap_label_pairs(labels, diagonal)
+        if len(labels1):
+            # Join up clouds that touch across a boundary. Each joined cloud takes the lowest of its
+            # labels, i.e. the one found first.
+            graph = coo_matrix((np.ones(len(labels1)), (labels1, labels2)),
+                               shape=(num_labels + 1, num_labels + 1))
+            num_components, components = connected_components(graph, directed=False)
+            lowest_labels = np.full(num_components, num_labels + 1)
+            np.minimum.at(lowest_labels, components, cloud_labels)
+            cloud_labels = lowest_labels[components]
+    return labels, num_labels, slice_last_labels, cloud_labels
+
+
+def _count_per_slice(is_cloud_label, slice_last_labels):
+    cloud_numbers = np.cumsum(is_cloud_label)
+    slice_offsets = np.concatenate([[0], cloud_numbers[slice_last_labels[:-1]]])
+    return cloud_numbers, slice_offsets, cloud_numbers[slice_last_labels] - slice_offsets
+
+
+def label_clds_batch(cld_fields, diagonal=False, wrap=True):
+    """Label contiguous clouds in each (lat, lon) slice of a (time, lat, lon) stack in one call.
+
+    Equivalent to calling cloud_tracking.utils.label_clds(cld_field, diagonal) on each slice:
+    uses 8-connectivity if diagonal, 4-connectivity otherwise, and if wrap the domain is treated
+    as bicyclic. In each slice, clouds are numbered from 1 in the order that they are first
+    found when scanning the slice row by row.
+
+    Returns num_clds, an array with the number of clouds in each slice (i.e. the max label), and
+    the labelled clouds, which has the same shape as cld_fields.
+    """
+    if np.shape(cld_fields)[0] == 0:
+        # e.g. an empty time chunk.
+        return np.zeros(0, dtype=int), np.zeros(np.shape(cld_fields), dtype=np.int32)
+    labels, num_labels, slice_last_labels, cloud_labels = _label_and_join_clds(cld_fields,
+                                                                               diagonal, wrap)
+    label_slices = np.searchsorted(slice_last_labels, np.arange(num_labels + 1))
+
+    # Number the clouds consecutively over the stack, then remove the offset for each slice.
+    is_cloud_label = np.zeros(num_labels + 1, dtype=bool)
+    is_cloud_label[cloud_labels[1:]] = True
+    cloud_numbers, slice_offsets, num_clds = _count_per_slice(is_cloud_label, slice_last_labels)
+
+    new_labels = cloud_numbers[cloud_labels] - slice_offsets[label_slices]
+    new_labels[0] = 0
+    return num_clds, new_labels.astype(labels.dtype)[labels]
+
+
+def count_clds_batch(cld_fields, diagonal=False, wrap=True):
+    """Count contiguous clouds in each (lat, lon) slice of a (time, lat, lon) stack in one call.
+
+    Gives the same counts as label_clds_batch (and label_clds), but does not build the labelled
+    clouds.
+
+    Returns an array with the number of clouds in each slice.
+    """
+    if np.shape(cld_fields)[0] == 0:
+        return np.zeros(0, dtype=int)
+    _, num_labels, slice_last_labels, cloud_labels = _label_and_join_clds(cld_fields,
+                                                                          diagonal, wrap)
+    # Each cloud is counted once: by the label that all its labels are joined onto.
+    is_cloud_label = cloud_labels == np.arange(num_labels + 1)
+    is_cloud_label[0] = False
+    return _count_per_slice(is_cloud_label, slice_last_labels)[2]
+
+
+def _periodic_positions(indices, cloud_ids, num_clouds, size):
+    """Centroid and min/max grid index of each cloud, along one periodic dim of length size.
+
+    Each cell's index is unwrapped to be within size / 2 of its cloud's circular mean index, so
+    clouds that cross the boundary are handled. Their bounds are < 0 or >= size.
+    """
+    angles = 2 * np.pi * indices / size
+    cos_sum = np.bincount(cloud_ids, weights=np.cos(angles), minlength=num_clouds)
+    sin_sum = np.bincount(cloud_ids, weights=np.sin(angles), minlength=num_clouds)
+    centres = np.round(np.arctan2(sin_sum, cos_sum) * size / (2 * np.pi)).astype(int) % size
+
+    offsets = (indices - centres[cloud_ids] + size // 2) % size - size // 2
+    counts = np.bincount(cloud_ids, minlength=num_clouds)
+    centroids = (centres + np.bincount(cloud_ids, weights=offsets, minlength=num_clouds) /
+                 np.maximum(counts, 1)) % size
+    min_offsets = np.full(num_clouds, size)
+    max_offsets = np.full(num_clouds, -size)
+    np.minimum.at(min_offsets, cloud_ids, offsets)
+    np.maximum.at(max_offsets, cloud_ids, offsets)
+    return centroids, centres + min_offsets, centres + max_offsets
+
+
+def cloud_properties(labelled_clouds, num_clds, mass_flux, w):
+    """Calc properties of every cloud in each (lat, lon) slice of a (slice, lat, lon) stack.
+
+    labelled_clouds and num_clds are as returned by label_clds_batch. mass_flux and w must have the
+    same shape as labelled_clouds. The domain is treated as bicyclic: centroids are means of the
+    grid indices unwrapped around each cloud, and bounding boxes can extend past the domain edges.
+
+    Returns an OrderedDict of 1D columns, with one entry per cloud, ordered by slice then cloud
+    label. Positions and bounds are in grid indices: i for lat, j for lon.
+    """
+    labelled_clouds = np.asarray(labelled_clouds)
+    num_clds = np.asarray(num_clds, dtype=int)
+    assert labelled_clouds.ndim == 3
+    assert mass_flux.shape == w.shape == labelled_clouds.shape
+    nslice, ny, nx = labelled_clouds.shape
+    num_clouds = int(num_clds.sum())
+
+    # Give each cloud in the stack a unique id: 0 to num_clouds - 1.
+    slice_offsets = np.concatenate([[0], np.cumsum(num_clds)[:-1]])
+    slice_indices, i_indices, j_indices = np.nonzero(labelled_clouds)
+    labels = labelled_clouds[slice_indices, i_indices, j_indices].astype(int)
+    cloud_ids = slice_offsets[slice_indices] + labels - 1
+
+    properties = OrderedDict()
+    properties['slice_index'] = np.repeat(np.arange(nslice), num_clds)
+    properties['cloud_index'] = (np.arange(num_clouds) -
+                                 np.repeat(slice_offsets, num_clds) + 1)
+    properties['area'] = np.bincount(cloud_ids, minlength=num_clouds)
+    (properties['centroid_i'],
+     properties['bbox_imin'],
+     properties['bbox_imax']) = _periodic_positions(i_indices, cloud_ids, num_clouds, ny)
+    (properties['centroid_j'],
+     properties['bbox_jmin'],
+     properties['bbox_jmax']) = _periodic_positions(j_indices, cloud_ids, num_clouds, nx)
+    properties['mass_flux'] = np.bincount(cloud_ids,
+                                          weights=mass_flux[slice_indices, i_indices, j_indices],
+                                          minlength=num_clouds)
+    max_w = np.full(num_clouds, -np.inf, dtype=w.dtype)
+    np.maximum.at(max_w, cloud_ids, w[slice_indices, i_indices, j_indices])
+    properties['max_w'] = max_w
+    return properties
+
+
+def cloud_centroids(labelled_clouds, X, Y, LX, LY, circular=False):
+    """Calc the centroid of each cloud in a labelled (lat, lon) field in one pass.
+
+    X and Y are the x, y coords of each cell, with the same shape as labelled_clouds. If circular,
+    the centroids are circular means over the bicyclic LX x LY domain, so clouds that cross the
+    boundary are in the right place. Otherwise they are the plain mean of X and Y.
+
+    Returns an (N, 2) array of (x, y) centroids, for clouds 1 to N (the max label).
+    """
+    labels = np.asarray(labelled_clouds).ravel()
+    # N.B. int(...) - labels can be stored as uint8, which would overflow.
+    num_labels = int(labels.max()) + 1 if len(labels) else 1
+    counts = np.bincount(labels, minlength=num_labels)[1:]
+    cloud_pos = np.empty((len(counts), 2))
+    for dim, (coords, L) in enumerate([(X, LX), (Y, LY)]):
+        coords = np.asarray(coords).ravel()
+        if circular:
+            angles = 2 * np.pi * coords / L
+            cos_sum = np.bincount(labels, weights=np.cos(angles), minlength=num_labels)[1:]
+            sin_sum = np.bincount(labels, weights=np.sin(angles), minlength=num_labels)[1:]
+            cloud_pos[:, dim] = (np.arctan2(sin_sum, cos_sum) * L / (2 * np.pi)) % L
+        else:
+            cloud_pos[:, dim] = np.bincount(labels, weights=coords,
+                                            minlength=num_labels)[1:] / counts
+    return cloud_pos
+
+
+def _cloud_distances_cutoff(cloud_pos, LX, LY, min_image, cutoff):
+    """As cloud_distances, but using KD-trees to find only the distances <= cutoff."""
+    if min_image:
+        # Tree that knows about the bicyclic domain: gives the min image distance.
+        tree = cKDTree(cloud_pos % [LX, LY], boxsize=[LX, LY])
+        pairs = tree.query_pairs(cutoff, output_type='ndarray')
+        pairs.sort(axis=1)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        diffs = np.abs(cloud_pos[pairs[:, 0]] - cloud_pos[pairs[:, 1]]) % [LX, LY]
+        diffs = np.minimum(diffs, [LX, LY] - diffs)
+        return np.sqrt(diffs[:, 0]**2 + diffs[:, 1]**2)
+
+    tree = cKDTree(cloud_pos)
+    i_indices, j_indices, image_indices, dists = [], [], [], []
+    image_offsets = [(ii, jj) for ii in [-1, 0, 1] for jj in [-1, 0, 1]]
+    for image_index, (ii, jj) in enumerate(image_offsets):
+        image_tree = cKDTree(cloud_pos + [ii * LX, jj * LY])
+        sdm = tree.sparse_distance_matrix(image_tree, cutoff, output_type='ndarray')
+        sdm = sdm[sdm['i'] < sdm['j']]
+        i_indices.append(sdm['i'])
+        j_indices.append(sdm['j'])
+        image_indices.append(np.full(len(sdm), image_index))
+        dists.append(sdm['v'])
+    i_indices, j_indices, image_indices, dists = [np.concatenate(a) for a in
+                                                  [i_indices, j_indices, image_indices, dists]]
+    # Same order as without cutoff: by pair, then by image.
+    order = np.lexsort((image_indices, j_indices, i_indices))
+    return dists[order]
+
+
+def cloud_distances(cloud_pos, LX, LY, min_image=False, cutoff=None):
+    """Calc the distances between every pair of clouds on a bicyclic LX x LY domain.
+
+    cloud_pos must be an (N, 2) array of (x, y) positions. Pairs are ordered as (0, 1), (0, 2), ...
+    (1, 2), ..., i.e. as np.triu_indices(N, 1).
+
+    For each pair, the distances from the first cloud to all 9 images of the second cloud are
+    returned, ordered by x offset then y offset (each -1, 0, 1 domain lengths), with shape
+    (num_pairs * 9). If min_image is True, only the distance to the nearest image is returned,
+    with shape (num_pairs).
+
+    If cutoff is set, only the distances <= cutoff are returned (in the same order). These are
+    found with KD-trees, so cost is roughly O(N log N), not O(N**2).
+    """
+    cloud_pos = np.asarray(cloud_pos, dtype=float).reshape(-1, 2)
+    if cutoff is not None:
+        return _cloud_distances_cutoff(cloud_pos, LX, LY, min_image, cutoff)
+
+    i_indices, j_indices = np.triu_indices(len(cloud_pos), 1)
+    x1, y1 = cloud_pos[i_indices, 0], cloud_pos[i_indices, 1]
+    x2, y2 = cloud_pos[j_indices, 0], cloud_pos[j_indices, 1]
+
+    if min_image:
+        dx = np.abs(x1 - x2) % LX
+        dy = np.abs(y1 - y2) % LY
+        dx = np.minimum(dx, LX - dx)
+        dy = np.minimum(dy, LY - dy)
+        return np.sqrt(dx**2 + dy**2)
+
+    # (pair, image) - same arithmetic as working out each image's position then the distance to it.
+    image_offsets = np.array([-1, 0, 1])
+    x_offsets = np.repeat(image_offsets, 3) * LX
+    y_offsets = np.tile(image_offsets, 3) * LY
+    x = x2[:, None] + x_offsets[None, :]
+    y = y2[:, None] + y_offsets[None, :]
+    dists = np.sqrt((x1[:, None] - x)**2 + (y1[:, None] - y)**2)
+    return dists.ravel()
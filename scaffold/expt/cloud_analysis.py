@@ -1,3 +1,8 @@
+import glob
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
 from logging import getLogger
 
 import matplotlib
@@ -5,27 +10,59 @@ import matplotlib
 matplotlib.use('Agg')
 import numpy as np
 import iris
-
-from cloud_tracking.utils import label_clds
+import pandas as pd
 
 from omnium import Analyser
 from omnium.utils import get_cube
 from omnium.consts import Re
 
+from scaffold.cloud_utils import (threshold_clouds, cloud_mask_thresh_data,
+                                  cloud_mask_thresh_pairs, label_clds_batch, cloud_properties)
+from scaffold.level_reader import load_levels
+from scaffold.utils import interp_vert_rho2w
+from scaffold.vertlev import VertLev
+
 logger = getLogger('scaf.ca')
 
 
+def concatenate_time_chunks(cubes):
+    """Join the cubes from each time chunk back up into one cube.
+
+    Array attributes (e.g. heights) are checked to be the same in every chunk, then taken off
+    the (freshly loaded) chunk cubes while concatenating and put back after: some iris versions
+    raise a ValueError when comparing array attributes."""
+    array_attrs = OrderedDict((key, value) for key, value in cubes[0].attributes.items()
+                              if isinstance(value, np.ndarray))
+    for cube in cubes:
+        for key, value in array_attrs.items():
+            assert np.array_equal(cube.attributes.pop(key), value)
+    cube = iris.cube.CubeList(cubes).concatenate_cube()
+    cube.attributes.update(array_attrs)
+    return cube
+
+
+def cloud_catalogue_filename(cloud_analysis_filename):
+    "Filename of the cloud catalogue that cloud_analysis writes alongside its .nc output."
+    assert cloud_analysis_filename.endswith('.cloud_analysis.nc')
+    return cloud_analysis_filename[:-len('.cloud_analysis.nc')] + '.cloud_catalogue.hdf'
+
+
 class CloudAnalyser(Analyser):
     """Performs thresholding of w, qcl to determine where clouds are.
 
     Does thresholding on height_levels.
     Performs analysis once for each combination of height_level, w_thresh, qcl_thresh.
+    If settings.threshold_pairs is set, only uses these (w_thresh, qcl_thresh) pairs.
 
     Outputs cloud_mask: result of combined (&'ed) w and qcl thresholding.
-    cloud_mask has coords for the height_level, w_thresh and qcl_thresh used.
+    cloud_mask has coords for the height_level, w_thresh and qcl_thresh used. If threshold_pairs
+    is used, it has a thresh_index dim instead of w_thres and qcl_thres dims, and w_thres and
+    qcl_thres are aux coords on this dim. Use scaffold.cloud_utils to read either layout.
+    cloud_mask is stored as uint8 (0/1) - read it back with .astype(bool), which does not widen.
     Also output w, qcl and rho slices for future analysis.
 
     Additionally, labels clouds by identifying contiguous regions in the cloud mask.
+    Labelled clouds are stored using the smallest unsigned int type that holds the max label.
     Defined diagonally, with wrapping:
     XXXXXXXXXXXXXXXXXX
     X  111   2  3   4X
@@ -33,13 +70,23 @@ class CloudAnalyser(Analyser):
     X     22   33    X
     X4         3    4X
     XXXXXXXXXXXXXXXXXX
+
+    Also outputs a cloud catalogue: a table with one row per (time, height, thresh, cloud), with
+    each cloud's area, centroid, mass flux, max w and bounding box (see
+    scaffold.cloud_utils.cloud_properties), which mass_flux_analysis uses for its per-cloud mass
+    fluxes. It is indexed on level_number and thresh_index, e.g.:
+    pd.read_hdf(filename, 'cloud_catalogue', where='level_number == 18 & thresh_index == 1')
+
+    If settings.cloud_analysis_time_chunk is set, the input file is processed in chunks of that
+    many time indices, so that memory use does not depend on the number of times in the file.
     """
     analysis_name = 'cloud_analysis'
     single_file = True
     input_dir = 'share/data/history/{expt}'
     input_filename_glob = '{input_dir}/atmos.???.pp1.nc'
     output_dir = 'omnium_output/{version_dir}/{expt}'
-    output_filenames = ['{output_dir}/atmos.{runid:03}.cloud_analysis.nc']
+    output_filenames = ['{output_dir}/atmos.{runid:03}.cloud_analysis.nc',
+                        '{output_dir}/atmos.{runid:03}.cloud_catalogue.hdf']
     uses_runid = True
     runid_pattern = 'atmos.(?P<runid>\d{3}).pp1.nc'
 
@@ -47,22 +94,90 @@ class CloudAnalyser(Analyser):
         self.load_cubes()
 
     def run(self):
-        self._apply_cloud_thresholds()
-        self._label_clouds()
+        self.chunk_dir = None
+        self.cloud_catalogues = []
+        self.vertlevs = VertLev(self.suite.suite_dir)
+        if self.settings.cloud_analysis_time_chunk:
+            try:
+                self._run_time_chunks(self.settings.cloud_analysis_time_chunk)
+            except BaseException:
+                self._remove_chunk_dir()
+                raise
+        else:
+            self._apply_cloud_thresholds()
+            self._label_clouds()
 
     def save(self, state, suite):
-        self.save_results_cubes(state, suite)
-
-    def _apply_cloud_thresholds(self):
+        try:
+            self.save_results_cubes(state, suite)
+            cloud_catalogue = pd.concat(self.cloud_catalogues, ignore_index=True)
+            cloud_catalogue.to_hdf(self.task.output_filenames[1], key='cloud_catalogue',
+                                   format='table', data_columns=['level_number', 'thresh_index'])
+        finally:
+            self._remove_chunk_dir()
+
+    def _chunk_dir_prefix(self):
+        return os.path.basename(self.output_filename) + '.chunks.'
+
+    def _remove_chunk_dir(self):
+        if self.chunk_dir:
+            logger.debug('removing {}'.format(self.chunk_dir))
+            shutil.rmtree(self.chunk_dir, ignore_errors=True)
+            self.chunk_dir = None
+
+    def _run_time_chunks(self, time_chunk):
+        """Threshold and label the input file in chunks of time_chunk time indices.
+
+        Each chunk's results are saved to their own file, so that only one chunk's data is in
+        memory at once. The chunk files are then lazily joined back up, so that save(...) can
+        stream them into the output file.
+
+        The chunk files are written to a temporary dir next to the output file, which is removed
+        by save(...) or if anything fails. Any chunk dirs left by a killed run are removed first.
+        """
+        output_dir = os.path.dirname(self.output_filename)
+        for old_chunk_dir in glob.glob(os.path.join(output_dir, self._chunk_dir_prefix() + '*')):
+            logger.warning('removing old chunk dir {}'.format(old_chunk_dir))
+            shutil.rmtree(old_chunk_dir, ignore_errors=True)
+        self.chunk_dir = tempfile.mkdtemp(prefix=self._chunk_dir_prefix(), dir=output_dir)
+
+        w = get_cube(self.cubes, 0, 150)
+        num_times = w.shape[0]
+        # Labelled clouds have to have the same dtype in all chunks to be joined. Use one that can
+        # hold the most clouds there can be on the (bicyclic) domain.
+        max_num_clds = ((w.shape[-2] + 1) // 2) * ((w.shape[-1] + 1) // 2)
+        labels_dtype = np.min_scalar_type(max_num_clds)
+
+        cube_ids = []
+        chunk_filenames = []
+        for chunk_index, start in enumerate(range(0, num_times, time_chunk)):
+            time_slice = slice(start, min(start + time_chunk, num_times))
+            logger.debug('running time chunk {}: {}'.format(chunk_index, time_slice))
+            self.results = OrderedDict()
+            self._apply_cloud_thresholds(time_slice)
+            self._label_clouds(labels_dtype, time_slice.start)
+
+            cube_ids = list(self.results.keys())
+            for cube_id, cube in self.results.items():
+                cube.attributes['omnium_cube_id'] = cube_id
+            chunk_filename = os.path.join(self.chunk_dir, 'chunk{:03}.nc'.format(chunk_index))
+            iris.save(list(self.results.values()), chunk_filename, zlib=True)
+            chunk_filenames.append(chunk_filename)
+
+        logger.debug('joining time chunks')
+        chunk_cubes = iris.load_raw(chunk_filenames)
+        self.results = OrderedDict()
+        for cube_id in cube_ids:
+            cubes = [c for c in chunk_cubes if c.attributes['omnium_cube_id'] == cube_id]
+            self.results[cube_id] = concatenate_time_chunks(cubes)
+
+    def _apply_cloud_thresholds(self, time_slice=slice(None)):
         cubes = self.cubes
 
         w = get_cube(cubes, 0, 150)
         qcl = get_cube(cubes, 0, 254)
         rho = get_cube(cubes, 0, 253)
 
-        rho.data = rho.data / Re**2
-        rho.units = 'kg m-3'
-
         rho_height_levels = []
         for height_level in self.settings.height_levels:
             # N.B. this is right *if you are running using pp1*.
@@ -71,20 +186,25 @@ class CloudAnalyser(Analyser):
         # ONLY use these to get coords.
         w_slice = w[:, self.settings.height_levels]
         rho_slice = w[:, rho_height_levels]
-        slice_coords = [(w.coord('time'), 0),
+        time_coord = w.coord('time')[time_slice]
+        slice_coords = [(time_coord, 0),
                         (w_slice.coord('model_level_number'), 1),
                         (w.coord('grid_latitude'), 2),
                         (w.coord('grid_longitude'), 3)]
 
-        rho_coords = [(w.coord('time'), 0),
+        rho_coords = [(time_coord, 0),
                       (rho_slice.coord('model_level_number'), 1),
                       (w.coord('grid_latitude'), 2),
                       (w.coord('grid_longitude'), 3)]
 
-        # WARNING, you have to do it like this or it's VERY SLOW.
-        # N.B. data deref'd *before* slice.
-        logger.debug('slicing data')
-        self.results['w_slice'] = iris.cube.Cube(w.data[:, self.settings.height_levels],
+        # N.B. only the data for height_levels/rho_height_levels is read from the file.
+        # Slicing the cubes then using .data is VERY SLOW if the data you are reading are
+        # compressed, and using w.data etc. then slicing reads all levels into memory.
+        logger.debug('loading data for height levels')
+        filename = self.task.filenames[0]
+        self.results['w_slice'] = iris.cube.Cube(load_levels(filename, w,
+                                                             self.settings.height_levels,
+                                                             time_slice),
                                                  long_name='w_slice',
                                                  units='m s-1',
                                                  dim_coords_and_dims=slice_coords)
@@ -92,87 +212,143 @@ class CloudAnalyser(Analyser):
         rho_heights = rho.coord('level_height').points[rho_height_levels]
         self.results['w_slice'].attributes['heights'] = theta_heights
 
-        self.results['qcl_slice'] = iris.cube.Cube(qcl.data[:, self.settings.height_levels],
+        self.results['qcl_slice'] = iris.cube.Cube(load_levels(filename, qcl,
+                                                               self.settings.height_levels,
+                                                               time_slice),
                                                    long_name='qcl_slice',
                                                    units='kg kg-1',
                                                    dim_coords_and_dims=slice_coords)
         self.results['qcl_slice'].attributes['heights'] = theta_heights
 
-        self.results['rho_slice'] = iris.cube.Cube(rho.data[:, rho_height_levels],
+        self.results['rho_slice'] = iris.cube.Cube(load_levels(filename, rho,
+                                                               rho_height_levels,
+                                                               time_slice) / Re**2,
                                                    long_name='rho_slice',
                                                    units='kg m-3',
                                                    dim_coords_and_dims=rho_coords)
         self.results['rho_slice'].attributes['heights'] = rho_heights
 
-        # VERY SLOW if data you are reading are compressed.
-        # w_slice = w[:, self.settings.height_levels]
-        # self.results['w_slice'] = w_slice
-        # self.results['w_slice'] = w_slice
-        # self.results['qcl_slice'] = qcl[:, self.settings.height_levels].copy()
-        # self.results['rho_slice'] = rho[:, rho_height_levels].copy()
-
-        cloud_mask_data = np.zeros((w.shape[0],
-                                    len(self.settings.height_levels),
-                                    len(self.settings.w_threshs),
-                                    len(self.settings.qcl_threshs),
-                                    w.shape[-2],
-                                    w.shape[-1]))
-
-        for h_index, height_level in enumerate(self.settings.height_levels):
-            for w_index, w_thresh in enumerate(self.settings.w_threshs):
-                for qcl_index, qcl_thresh in enumerate(self.settings.qcl_threshs):
-                    logger.debug('h, w, qcl index: ({}, {}, {})'.format(h_index, w_index, qcl_index))
-                    w_mask = w[:, height_level].data > w_thresh
-                    qcl_mask = qcl[:, height_level].data > qcl_thresh
-
-                    cloud_mask_data[:, h_index, w_index, qcl_index] = (w_mask & qcl_mask).astype(int)
-
-        w_thresh_coord = iris.coords.DimCoord(self.settings.w_threshs, long_name='w_thres', units='m s-1')
-        qcl_thresh_coord = iris.coords.DimCoord(self.settings.qcl_threshs, long_name='qcl_thres', units='kg kg-1')
-        cloud_mask_cube = iris.cube.Cube(cloud_mask_data,
-                                         long_name='cloud_mask',
-                                         dim_coords_and_dims=[(w.coord('time'), 0),
-                                                              (w_slice.coord('model_level_number'), 1),
-                                                              (w_thresh_coord, 2),
-                                                              (qcl_thresh_coord, 3),
-                                                              (w.coord('grid_latitude'), 4),
-                                                              (w.coord('grid_longitude'), 5)])
+        slice_dims = [(time_coord, 0),
+                      (w_slice.coord('model_level_number'), 1)]
+        latlon_coords = [w.coord('grid_latitude'), w.coord('grid_longitude')]
+        if self.settings.threshold_pairs:
+            # Only threshold using the requested (w_thresh, qcl_thresh) pairs.
+            w_threshs, qcl_threshs = zip(*self.settings.threshold_pairs)
+            logger.debug('thresholding data for pairs: {}'.format(self.settings.threshold_pairs))
+            cloud_mask_data = threshold_clouds(self.results['w_slice'].data,
+                                               self.results['qcl_slice'].data,
+                                               w_threshs, qcl_threshs, pairs=True)
+
+            thresh_index_coord = iris.coords.DimCoord(range(len(w_threshs)),
+                                                      long_name='thresh_index')
+            w_thresh_coord = iris.coords.AuxCoord(w_threshs, long_name='w_thres', units='m s-1')
+            qcl_thresh_coord = iris.coords.AuxCoord(qcl_threshs, long_name='qcl_thres',
+                                                    units='kg kg-1')
+            cloud_mask_cube = iris.cube.Cube(cloud_mask_data,
+                                             long_name='cloud_mask',
+                                             dim_coords_and_dims=slice_dims +
+                                             [(thresh_index_coord, 2),
+                                              (latlon_coords[0], 3),
+                                              (latlon_coords[1], 4)],
+                                             aux_coords_and_dims=[(w_thresh_coord, 2),
+                                                                  (qcl_thresh_coord, 2)])
+        else:
+            # Threshold the sliced data for all w_thresh/qcl_thresh combinations in one go.
+            logger.debug('thresholding data')
+            cloud_mask_data = threshold_clouds(self.results['w_slice'].data,
+                                               self.results['qcl_slice'].data,
+                                               self.settings.w_threshs,
+                                               self.settings.qcl_threshs)
+
+            w_thresh_coord = iris.coords.DimCoord(self.settings.w_threshs, long_name='w_thres',
+                                                  units='m s-1')
+            qcl_thresh_coord = iris.coords.DimCoord(self.settings.qcl_threshs,
+                                                    long_name='qcl_thres', units='kg kg-1')
+            cloud_mask_cube = iris.cube.Cube(cloud_mask_data,
+                                             long_name='cloud_mask',
+                                             dim_coords_and_dims=slice_dims +
+                                             [(w_thresh_coord, 2),
+                                              (qcl_thresh_coord, 3),
+                                              (latlon_coords[0], 4),
+                                              (latlon_coords[1], 5)])
 
         self.results['cloud_mask'] = cloud_mask_cube
 
-    def _label_clouds(self):
+    def _label_clouds(self, labels_dtype=None, time_offset=0):
         cloud_mask_cube = self.results['cloud_mask']
         w_slice = self.results['w_slice']
 
-        w_thresh_coord = cloud_mask_cube.coord('w_thres')
-        qcl_thresh_coord = cloud_mask_cube.coord('qcl_thres')
         level_number_coord = cloud_mask_cube.coord('model_level_number')
+        cloud_mask_data = cloud_mask_thresh_data(cloud_mask_cube)
+
+        # Label every (time, height, thresh) slice in one go.
+        logger.debug('labelling clouds')
+        cloud_mask_stack = cloud_mask_data.reshape((-1,) + cloud_mask_data.shape[3:])
+        num_clds, all_labelled_clouds = label_clds_batch(cloud_mask_stack, diagonal=True)
+        num_clds = num_clds.reshape(cloud_mask_data.shape[:3])
+        all_labelled_clouds = all_labelled_clouds.reshape(cloud_mask_data.shape)
+        self._build_cloud_catalogue(all_labelled_clouds, num_clds, time_offset)
 
         # level_number refers to orig cube.
         # height_level_index refers to w as it has already picked out the height levels.
         for height_level_index, level_number in enumerate(level_number_coord.points):
 
-            for thresh_index in range(w_thresh_coord.shape[0]):
-                # N.B. I just take the diagonal indices.
-                w_thresh = w_thresh_coord.points[thresh_index]
-                qcl_thresh = qcl_thresh_coord.points[thresh_index]
-
-                labelled_clouds_cube = w_slice[:, height_level_index].copy()
+            thresh_pairs = cloud_mask_thresh_pairs(cloud_mask_cube)
+            for thresh_index, (w_thresh, qcl_thresh) in enumerate(thresh_pairs):
+                # N.B. I just take the diagonal indices (or the threshold_pairs).
+                labelled_clouds_data = all_labelled_clouds[:, height_level_index, thresh_index]
+                # Store as the smallest unsigned int that can hold all the labels.
+                cube_labels_dtype = labels_dtype
+                if cube_labels_dtype is None:
+                    cube_labels_dtype = np.min_scalar_type(int(labelled_clouds_data.max()))
+                labelled_clouds_cube = w_slice[:, height_level_index].copy(
+                    data=labelled_clouds_data.astype(cube_labels_dtype))
                 labelled_clouds_cube.units = ''
 
-                labelled_clouds_data = np.zeros_like(labelled_clouds_cube.data)
-                for time_index in range(cloud_mask_cube.data.shape[0]):
-                    cloud_mask_ss = cloud_mask_cube[time_index,
-                                                    height_level_index,
-                                                    thresh_index,
-                                                    thresh_index].data.astype(bool)
-                    max_cld_index, labelled_clouds = label_clds(cloud_mask_ss, diagonal=True)
-                    labelled_clouds_data[time_index] = labelled_clouds
-
                 labelled_clouds_cube_id = 'labelled_clouds_z{}_w{}_qcl{}'.format(level_number,
                                                                                  w_thresh,
                                                                                  qcl_thresh)
 
                 labelled_clouds_cube.rename(labelled_clouds_cube_id)
-                labelled_clouds_cube.data = labelled_clouds_data
                 self.results[labelled_clouds_cube_id] = labelled_clouds_cube
+
+    def _build_cloud_catalogue(self, all_labelled_clouds, num_clds, time_offset):
+        """Calc the properties of every cloud, and store them as one table row per cloud."""
+        cloud_mask_cube = self.results['cloud_mask']
+        w_slice = self.results['w_slice']
+        lat = w_slice.coord('grid_latitude').points
+        lon = w_slice.coord('grid_longitude').points
+        dy = lat[1] - lat[0]
+        dx = lon[1] - lon[0]
+
+        logger.debug('building cloud catalogue')
+        w = w_slice.data
+        mf = interp_vert_rho2w(self.vertlevs, w_slice, self.results['rho_slice']) * w
+        # (time, height) stacks, which do not need to be copied.
+        w_stack = w.reshape((-1,) + w.shape[2:])
+        mf_stack = mf.reshape((-1,) + mf.shape[2:])
+        num_heights = w.shape[1]
+
+        level_numbers = cloud_mask_cube.coord('model_level_number').points
+        times = w_slice.coord('time').points
+        thresh_pairs = cloud_mask_thresh_pairs(cloud_mask_cube)
+        for thresh_index, (w_thresh, qcl_thresh) in enumerate(thresh_pairs):
+            labelled_clouds = all_labelled_clouds[:, :, thresh_index]
+            properties = cloud_properties(labelled_clouds.reshape(w_stack.shape),
+                                          num_clds[:, :, thresh_index].ravel(),
+                                          mf_stack, w_stack)
+            time_indices, height_level_indices = np.divmod(properties.pop('slice_index'),
+                                                           num_heights)
+            # Positions are at cell centres, in the same units as lat/lon coords.
+            properties['centroid_x'] = (properties['centroid_j'] + 0.5) * dx
+            properties['centroid_y'] = (properties['centroid_i'] + 0.5) * dy
+
+            cloud_catalogue = pd.DataFrame(properties)
+            cloud_catalogue.insert(0, 'runid', self.task.runid)
+            cloud_catalogue.insert(1, 'time_index', time_indices + time_offset)
+            cloud_catalogue.insert(2, 'time', times[time_indices])
+            cloud_catalogue.insert(3, 'level_number', level_numbers[height_level_indices])
+            cloud_catalogue.insert(4, 'thresh_index', thresh_index)
+            cloud_catalogue.insert(5, 'w_thresh', w_thresh)
+            cloud_catalogue.insert(6, 'qcl_thresh', qcl_thresh)
+            self.cloud_catalogues.append(cloud_catalogue)
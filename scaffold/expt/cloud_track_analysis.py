@@ -3,13 +3,14 @@ import os
 from logging import getLogger
 import pickle
 
-import numpy as np
 from cloud_tracking import Tracker
 from cloud_tracking.cloud_tracking_analysis import generate_stats, output_stats_to_file
 
 from omnium import Analyser, ExptList
 from omnium.utils import get_cube_from_attr
 
+from scaffold.cloud_utils import cloud_mask_thresh_pairs, cloud_mask_thresh_slice
+
 logger = getLogger('scaf.cta')
 
 
@@ -46,8 +47,6 @@ class CloudTrackAnalyser(Analyser):
         cloud_mask_id = 'cloud_mask'
         cloud_mask_cube = get_cube_from_attr(cubes, 'omnium_cube_id', cloud_mask_id)
 
-        w_thresh_coord = cloud_mask_cube.coord('w_thres')
-        qcl_thresh_coord = cloud_mask_cube.coord('qcl_thres')
         level_number_coord = cloud_mask_cube.coord('model_level_number')
         logger.debug(cloud_mask_cube.shape)
 
@@ -61,7 +60,8 @@ class CloudTrackAnalyser(Analyser):
         # height_level refers to orig cube.
         # height_level_index refers to w as it has already picked out the height levels.
         for height_level_index, level_number in enumerate(level_number_coord.points):
-            for thresh_index in range(w_thresh_coord.shape[0]):
+            thresh_pairs = cloud_mask_thresh_pairs(cloud_mask_cube)
+            for thresh_index, (w_thresh, qcl_thresh) in enumerate(thresh_pairs):
                 # TODO: reinstate
                 # if height_level_index != 1 and thresh_index != 1:
 
@@ -74,8 +74,6 @@ class CloudTrackAnalyser(Analyser):
                 logger.debug('height_index, thresh_index: {}, {}'.format(height_level_index,
                                                                          thresh_index))
 
-                w_thresh = w_thresh_coord.points[thresh_index]
-                qcl_thresh = qcl_thresh_coord.points[thresh_index]
                 labelled_clouds_cube_id = 'labelled_clouds_z{}_w{}_qcl{}'.format(level_number,
                                                                                  w_thresh,
                                                                                  qcl_thresh)
@@ -83,15 +81,13 @@ class CloudTrackAnalyser(Analyser):
                                                           'omnium_cube_id',
                                                           labelled_clouds_cube_id)
 
-                cld_field = np.zeros(cloud_mask_cube[:, height_level_index, thresh_index, thresh_index].shape, dtype=int)
-                cld_field_cube = cloud_mask_cube[:, height_level_index, thresh_index, thresh_index].copy()
+                cloud_mask_slice = cloud_mask_thresh_slice(cloud_mask_cube,
+                                                           height_level_index, thresh_index)
+                # N.B. cloud_tracking works with int labels, labelled clouds can be stored as
+                # uint8 - make one int copy of all the labels.
+                cld_field_cube = cloud_mask_slice.copy(data=labelled_clouds_cube.data.astype(int))
                 cld_field_cube.rename('cloud_field')
 
-                for time_index in range(cloud_mask_cube.shape[0]):
-                    labelled_clouds_ss = labelled_clouds_cube[time_index].data.astype(int)
-                    cld_field[time_index] = labelled_clouds_ss
-                cld_field_cube.data = cld_field
-
                 tracker = Tracker(cld_field_cube.slices_over('time'), expt_obj.dx, expt_obj.dy,
                                   include_touching=True,
                                   touching_diagonal=True,
@@ -3,6 +3,7 @@ from logging import getLogger
 import configparser as cp
 
 import iris
+import numpy as np
 
 from omnium import Analyser
 from omnium.utils import get_cube
@@ -10,7 +11,18 @@ from omnium.utils import get_cube
 logger = getLogger('scaf.dump_extract')
 
 
+def level_sums_counts(cube):
+    "Sum and count (of unmasked values) on each level of a (level, lat, lon) cube."
+    data = np.ma.asarray(cube.data)
+    return data.sum(axis=(1, 2), dtype=np.float64).filled(0), data.count(axis=(1, 2))
+
+
 class DumpExtractState(Analyser):
+    """Extracts mean theta and mv profiles from the dumps, to use as relaxation profiles.
+
+    Dumps are read one at a time, and only running sums and counts on each level are kept,
+    so only one dump needs to be in memory.
+    """
     analysis_name = 'dump_extract_state'
     multi_file = True
     input_dir = 'share/data/history/{expt}'
@@ -23,8 +35,9 @@ class DumpExtractState(Analyser):
 
     def load(self):
         filenames = self.task.filenames
-        theta = []
-        mv = []
+        self.z = None
+        self.theta_sums, self.theta_counts = 0, 0
+        self.mv_sums, self.mv_counts = 0, 0
         for dump_filename in filenames:
             if self.suite.check_filename_missing(dump_filename):
                 logger.debug('filename {} missing, skipping', dump_filename)
@@ -38,16 +51,22 @@ class DumpExtractState(Analyser):
             da = iris.load(dump_filename)
             da_theta = get_cube(da, 0, 4)
             da_mv = get_cube(da, 0, 391)
-            theta.append(da_theta)
-            mv.append(da_mv)
 
-        self.theta = iris.cube.CubeList.merge(theta)[0]
-        self.mv = iris.cube.CubeList.merge(mv)[0]
-        self.z = self.theta.coord('atmosphere_hybrid_height_coordinate').points
+            z = da_theta.coord('atmosphere_hybrid_height_coordinate').points
+            if self.z is None:
+                self.z = z
+            assert (z == self.z).all()
+
+            theta_sums, theta_counts = level_sums_counts(da_theta)
+            mv_sums, mv_counts = level_sums_counts(da_mv)
+            self.theta_sums += theta_sums
+            self.theta_counts += theta_counts
+            self.mv_sums += mv_sums
+            self.mv_counts += mv_counts
 
     def run(self):
-        self.theta_profile = self.theta.data.mean(axis=(0, 2, 3))
-        self.mv_profile = self.mv.data.mean(axis=(0, 2, 3))
+        self.theta_profile = self.theta_sums / self.theta_counts
+        self.mv_profile = self.mv_sums / self.mv_counts
 
     def display_results(self):
         opt = cp.ConfigParser()
@@ -1,21 +1,27 @@
+import os
+
 import matplotlib
 import numpy as np
 
 matplotlib.use('Agg')
 import iris
+import pandas as pd
 
-from omnium import Analyser
+from omnium import Analyser, OmniumError
 from omnium.utils import get_cube_from_attr
 
-from scaffold.vertlev import VertLev
-from scaffold.utils import interp_vert_rho2w
+from scaffold.cloud_utils import cloud_mask_thresh_pairs
+from scaffold.expt.cloud_analysis import cloud_catalogue_filename
 
 
 class MassFluxAnalyser(Analyser):
     """Works out the mass flux for each cloud.
 
-    Uses the output from cloud_analysis, and labels each of the contiguous clouds
-    (with diagonal=True). Uses these clouds to work out the mass flux for each cloud.
+    Uses the output from cloud_analysis: the clouds are labelled (with diagonal=True) and the mass
+    flux of each is calculated there, and stored in the cloud catalogue. This reads the mass flux
+    of every cloud, and the total mass flux and cloud fraction (sigma) for each time, from the
+    catalogue. The catalogue is only written by cloud_analysis since it started making one: older
+    cloud_analysis output has to be rerun.
 
     """
     analysis_name = 'mass_flux_analysis'
@@ -29,6 +35,13 @@ class MassFluxAnalyser(Analyser):
 
     def load(self):
         self.load_cubes()
+        catalogue_filename = cloud_catalogue_filename(self.task.filenames[0])
+        if not os.path.exists(catalogue_filename):
+            raise OmniumError('Cloud catalogue {} not found: rerun cloud_analysis for {}'
+                              .format(catalogue_filename, self.task.filenames[0]))
+        self.cloud_catalogue = pd.read_hdf(catalogue_filename, 'cloud_catalogue',
+                                           columns=['time_index', 'level_number', 'thresh_index',
+                                                    'cloud_index', 'area', 'mass_flux'])
 
     def run(self):
         cubes = self.cubes
@@ -39,46 +52,35 @@ class MassFluxAnalyser(Analyser):
         cloud_mask_id = 'cloud_mask'
         cloud_mask_cube = get_cube_from_attr(cubes, 'omnium_cube_id', cloud_mask_id)
 
-        w_thresh_coord = cloud_mask_cube.coord('w_thres')
-        qcl_thresh_coord = cloud_mask_cube.coord('qcl_thres')
         level_number_coord = cloud_mask_cube.coord('model_level_number')
 
+        num_times = cloud_mask_cube.shape[0]
         num_domain_grid_cells = w_slice.shape[2] * w_slice.shape[3]
+        # Mass flux (rho * w) has this dtype.
+        mf_dtype = np.result_type(rho_slice.dtype, w_slice.dtype)
+
+        cloud_catalogue = self.cloud_catalogue.sort_values(['time_index', 'cloud_index'],
+                                                           kind='mergesort')
+        catalogue_groups = cloud_catalogue.groupby(['level_number', 'thresh_index'])
 
-        vertlevs = VertLev(self.suite.suite_dir)
         # level_number refers to orig cube.
         # height_level_index refers to w as it has already picked out the height levels.
         for height_level_index, level_number in enumerate(level_number_coord.points):
-            for thresh_index in range(w_thresh_coord.shape[0]):
-                # N.B. I just take the diagonal indices.
-                w_thresh = w_thresh_coord.points[thresh_index]
-                qcl_thresh = qcl_thresh_coord.points[thresh_index]
-                labelled_clouds_cube_id = 'labelled_clouds_z{}_w{}_qcl{}'.format(level_number,
-                                                                                 w_thresh,
-                                                                                 qcl_thresh)
-                labelled_clouds_cube = get_cube_from_attr(cubes, 'omnium_cube_id', labelled_clouds_cube_id)
-
-                mass_fluxes = []
-                total_mass_fluxes = []
-                sigmas = []
-
-                for time_index in range(cloud_mask_cube.data.shape[0]):
-                    # w_ss == w_snapshot.
-                    w_ss = w_slice[time_index, height_level_index].data
-
-                    rho_ss_interp = interp_vert_rho2w(vertlevs, w_slice, rho_slice, time_index,
-                                                      height_level_index, level_number)
-
-                    labelled_clouds_ss = labelled_clouds_cube[time_index].data.astype(int)
-                    mf_ss = rho_ss_interp * w_ss
-                    max_labelled_cloud_index = np.max(labelled_clouds_ss)
-
-                    for i in range(1, max_labelled_cloud_index + 1):
-                        mask = (labelled_clouds_ss == i)
-                        mass_flux = mf_ss[mask].sum()
-                        mass_fluxes.append(mass_flux)
-                    total_mass_fluxes.append(mf_ss[labelled_clouds_ss >= 1].sum())
-                    sigmas.append((labelled_clouds_ss >= 1).sum() / num_domain_grid_cells)
+            thresh_pairs = cloud_mask_thresh_pairs(cloud_mask_cube)
+            for thresh_index, (w_thresh, qcl_thresh) in enumerate(thresh_pairs):
+                # N.B. I just take the diagonal indices (or the threshold_pairs).
+                key = (level_number, thresh_index)
+                if key in catalogue_groups.groups:
+                    clouds = catalogue_groups.get_group(key)
+                else:
+                    clouds = cloud_catalogue.iloc[:0]
+
+                mass_fluxes = clouds['mass_flux'].values.astype(mf_dtype)
+                time_indices = clouds['time_index'].values
+                total_mass_fluxes = np.bincount(time_indices, weights=clouds['mass_flux'].values,
+                                                minlength=num_times).astype(mf_dtype)
+                sigmas = np.bincount(time_indices, weights=clouds['area'].values,
+                                     minlength=num_times) / num_domain_grid_cells
 
                 mf_cube_id = 'mass_flux_z{}_w{}_qcl{}'.format(level_number, w_thresh, qcl_thresh)
                 values = iris.coords.DimCoord(range(len(mass_fluxes)), long_name='values')
@@ -94,9 +96,6 @@ class MassFluxAnalyser(Analyser):
                                                       dim_coords_and_dims=[(values, 0)],
                                                       units='kg m-2 s-1')
 
-                mass_flux_cube.attributes['mass_flux_key'] = (height_level_index, thresh_index)
-                total_mass_flux_cube.attributes['total_mass_flux_key'] = (height_level_index, thresh_index)
-
                 sigma_cube_id = 'sigma_z{}_w{}_qcl{}'.format(level_number, w_thresh, qcl_thresh)
                 values = iris.coords.DimCoord(range(len(sigmas)), long_name='values')
                 sigma_cube = iris.cube.Cube(sigmas,
@@ -5,8 +5,9 @@ import iris
 import numpy as np
 
 from omnium import Analyser
-from omnium.utils import get_cube_from_attr, coarse_grain
-from scaffold.utils import interp_vert_rho2w
+from omnium.utils import get_cube_from_attr
+from scaffold.cloud_utils import cloud_mask_thresh_data
+from scaffold.utils import interp_vert_rho2w, coarse_grain_pyramid, window_sums
 from scaffold.vertlev import VertLev
 
 logger = getLogger('scaf.mfssa')
@@ -17,6 +18,11 @@ class MassFluxSpatialScalesAnalyser(Analyser):
 
     conv. mf = mass flux where cloud_mask == true.
     Saves a separate file for each key (model_level_number, thresh_index, n).
+
+    If settings.mass_flux_spatial_ns is set, uses these n instead of powers of 2 (each n must
+    divide the domain's number of grid cells). If settings.mass_flux_spatial_sliding is also set,
+    uses overlapping subdomains (of the same size) starting at every grid cell, which wrap round
+    the bicyclic domain. Both use a summed-area table, so work for any n.
     """
     analysis_name = 'mass_flux_spatial_scales_analysis'
     single_file = True
@@ -39,39 +45,59 @@ class MassFluxSpatialScalesAnalyser(Analyser):
 
         cloud_mask_cube = get_cube_from_attr(cubes, 'omnium_cube_id', 'cloud_mask')
 
-        level_number_coord = cloud_mask_cube.coord('model_level_number')
+        cloud_mask_data = cloud_mask_thresh_data(cloud_mask_cube)
         vertlevs = VertLev(self.suite.suite_dir)
-
+        # Mass flux for every (time, height), at w points.
+        rho_interp = interp_vert_rho2w(vertlevs, w_slice, rho_slice)
+        mf = rho_interp * w_slice.data
+
+        num_times = cloud_mask_cube.shape[0]
+        num_heights, num_threshs = cloud_mask_data.shape[1:3]
+        N = mf.shape[-1]
+        ns = self.settings.mass_flux_spatial_ns
+        sliding = bool(self.settings.mass_flux_spatial_sliding)
+        if ns:
+            assert all(N % n == 0 for n in ns)
+        else:
+            ns = 2**np.arange(self.settings.npow)
+
+        # Preallocate the output for each key: each time gives n**2 values (or N**2 if sliding).
         mass_flux = OrderedDict()
-        for time_index in range(cloud_mask_cube.shape[0]):
-            logger.debug('time: {}/{}'.format(time_index + 1, cloud_mask_cube.shape[0]))
-
-            for height_level_index, level_number in enumerate(level_number_coord.points):
-                # One value of w_slice (w SnapShot) for each time/height.
-                w_ss = w_slice[time_index, height_level_index].data
-
-                rho_ss_interp = interp_vert_rho2w(vertlevs, w_slice, rho_slice, time_index,
-                                                  height_level_index, level_number)
-
-                mf_ss = rho_ss_interp * w_ss
-                N = mf_ss.shape[-1]
-
-                # There are 3 values of cloud_mask for each time/height:
-                for thresh_index in range(cloud_mask_cube.shape[2]):
-                    # N.B. take diagonal of thresh, i.e. low/low, med/med, hi/hi.
-                    cloud_mask_ss = cloud_mask_cube[time_index, height_level_index,
-                                                    thresh_index, thresh_index].data.astype(bool)
-                    # Heart of the analysis. Coarse grain the data.
-                    # i.e. split into 4, then 8, then 16... subdomains.
-                    # For each subdomain (and each power), save the convective mass flux for that
-                    # subdomain (convective == where cloud_mask is true). Store all of these.
-                    coarse_data = coarse_grain(mf_ss, cloud_mask_ss, self.settings.npow)
-                    for n, coarse_datum in coarse_data:
+        for height_level_index in range(num_heights):
+            for thresh_index in range(num_threshs):
+                for n in ns:
+                    num_values = N**2 if sliding else n**2
+                    mass_flux[(height_level_index, thresh_index, n)] = np.empty(num_times *
+                                                                                num_values)
+
+        for time_index in range(num_times):
+            logger.debug('time: {}/{}'.format(time_index + 1, num_times))
+
+            # One value of mf (mf SnapShot) for each height. There are 3 values of cloud_mask for
+            # each time/height, N.B. the diagonal of thresh, i.e. low/low, med/med, hi/hi.
+            # (or the threshold_pairs).
+            mf_ss = np.broadcast_to(mf[time_index, :, None], cloud_mask_data.shape[1:])
+            cloud_mask_ss = cloud_mask_data[time_index]
+            # Heart of the analysis. Coarse grain the data.
+            # i.e. split into 4, then 8, then 16... subdomains.
+            # For each subdomain (and each power), save the convective mass flux for that
+            # subdomain (convective == where cloud_mask is true). Store all of these.
+            if self.settings.mass_flux_spatial_ns:
+                windows = window_sums(mf_ss, cloud_mask_ss, [N // n for n in ns], sliding)
+                coarse_data = [(n, coarse_datum) for n, (_, coarse_datum) in zip(ns, windows)]
+            else:
+                coarse_data = coarse_grain_pyramid(mf_ss, cloud_mask_ss, self.settings.npow)
+
+            for n, coarse_datum in coarse_data:
+                Nsubdom = N / n
+                num_values = coarse_datum[0, 0].size
+                time_slice = slice(time_index * num_values, (time_index + 1) * num_values)
+                coarse_datum = (coarse_datum.reshape(num_heights, num_threshs, num_values) /
+                                Nsubdom**2)
+                for height_level_index in range(num_heights):
+                    for thresh_index in range(num_threshs):
                         key = (height_level_index, thresh_index, n)
-                        Nsubdom = N / n
-                        if key not in mass_flux:
-                            mass_flux[key] = []
-                        mass_flux[key] = np.append(mass_flux[key], coarse_datum.flatten() / Nsubdom**2)
+                        mass_flux[key][time_slice] = coarse_datum[height_level_index, thresh_index]
 
         for key, mass_fluxes in mass_flux.items():
             logger.debug('building iris cube for: {}'.format(key))
@@ -83,6 +109,10 @@ class MassFluxSpatialScalesAnalyser(Analyser):
                                                     units='kg s-1')
 
             mass_flux_spatial_cube.attributes['mass_flux_spatial_key'] = key
+            mass_flux_spatial_cube.attributes['mass_flux_spatial_sliding'] = int(sliding)
+            # Number of values for each time.
+            mass_flux_spatial_cube.attributes['mass_flux_spatial_num_values'] = (N**2 if sliding
+                                                                                 else key[2]**2)
             self.results[name] = mass_flux_spatial_cube
 
     def save(self, state, suite):
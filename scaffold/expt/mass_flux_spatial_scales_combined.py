@@ -5,7 +5,6 @@ from logging import getLogger
 import iris
 
 from omnium import Analyser
-from omnium.utils import is_power_of_two
 
 logger = getLogger('scaf.mfssc')
 
@@ -15,6 +14,8 @@ class MassFluxSpatialScalesCombined(Analyser):
 
     Only loads files greater than runid == start_runid.
     Loads/saves a separate file for each key (model_level_number, thresh_index, n).
+    Keeps the mass_flux_spatial_sliding and mass_flux_spatial_num_values (number of values for
+    each time) attributes, which must be the same for all runids.
     """
     analysis_name = 'mass_flux_spatial_scales_combined'
     multi_file = True
@@ -25,6 +26,7 @@ class MassFluxSpatialScalesCombined(Analyser):
 
     def load(self):
         self.spatial_mass_fluxes = defaultdict(list)
+        self.spatial_mass_flux_attrs = {}
         for filename in self.task.filenames:
             basename = os.path.basename(filename)
             runid = int(basename.split('.')[1])
@@ -35,7 +37,13 @@ class MassFluxSpatialScalesCombined(Analyser):
                     # N.B. need to deref this to use as a key.
                     (height_index, thresh_index, n) = cube.attributes['mass_flux_spatial_key']
                     key = (height_index, thresh_index, n)
-                    assert is_power_of_two(n)
+                    # N.B. n can be any number of subdomains (see mass_flux_spatial_ns).
+                    assert n >= 1
+
+                    # N.B. defaults are for files written before these attributes were added.
+                    attrs = (int(cube.attributes.get('mass_flux_spatial_sliding', 0)),
+                             int(cube.attributes.get('mass_flux_spatial_num_values', n**2)))
+                    assert self.spatial_mass_flux_attrs.setdefault(key, attrs) == attrs
 
                     self.spatial_mass_fluxes[key].extend(cube.data)
             else:
@@ -54,6 +62,9 @@ class MassFluxSpatialScalesCombined(Analyser):
                                                     dim_coords_and_dims=[(values, 0)],
                                                     units='kg s-1')
             mass_flux_spatial_cube.attributes['mass_flux_spatial_key'] = key
+            sliding, num_values = self.spatial_mass_flux_attrs[key]
+            mass_flux_spatial_cube.attributes['mass_flux_spatial_sliding'] = sliding
+            mass_flux_spatial_cube.attributes['mass_flux_spatial_num_values'] = num_values
             self.results[smf_cube_id] = mass_flux_spatial_cube
 
     def save(self, state, suite):
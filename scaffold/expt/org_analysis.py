@@ -1,3 +1,4 @@
+from functools import lru_cache
 from logging import getLogger
 
 import matplotlib
@@ -10,21 +11,40 @@ import iris
 from omnium import Analyser, ExptList
 from omnium.utils import get_cube_from_attr
 
+from scaffold.cloud_utils import cloud_mask_thresh_pairs, cloud_distances, cloud_centroids
+
 logger = getLogger('scaf.org_an')
 
 
-class Cloud:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+@lru_cache(maxsize=None)
+def _cell_centre_grids(LX, LY, NX, NY):
+    "x, y coords of the centre of each cell, for a given domain."
+    half_dx = LX / (2 * NX)
+    half_dy = LY / (2 * NY)
+    x = np.linspace(half_dx, LX - half_dx, NX)
+    y = np.linspace(half_dy, LY - half_dy, NY)
+    X, Y = np.meshgrid(x, y, indexing='xy')
+    return X, Y
 
 
 class OrgAnalyser(Analyser):
     """Calculates cloud-cloud distances for each pair of clouds, taking into account bicyclic dom.
 
     Works out where each cloud is (centroid), then calculates the cloud to cloud distance for every
-    cloud to every other cloud.
-    Performs once for each height level, and each pair of low/low, med/med, high/high threshs."""
+    cloud to every other cloud - to all 9 of its images, or if settings.org_min_image_dists is set
+    only to its nearest image.
+    If settings.org_circular_centroids is set, centroids are circular means over the domain, so
+    clouds that cross the boundary are in the right place.
+    Performs once for each height level, and each pair of low/low, med/med, high/high threshs.
+
+    If settings.org_dist_hist_bin_width is set, the distances are not stored. Instead, they are
+    accumulated into a histogram with fixed bins of that width (in m), which is saved (as
+    dist_hist_...) along with the total number of clouds.
+
+    If settings.org_dist_cutoff is set, only distances <= cutoff (in m) are found and used. This
+    uses KD-trees, so is much faster for large numbers of clouds. N.B. org_plot needs distances
+    out past LX / 2 to normalize the RDF, so the cutoff must be more than LX / 2 (plus
+    org_dist_hist_bin_width, if set): this is checked when loading."""
     analysis_name = 'org_analysis'
     single_file = True
     input_dir = 'omnium_output/{version_dir}/{expt}'
@@ -37,6 +57,21 @@ class OrgAnalyser(Analyser):
     def load(self):
         self.load_cubes()
 
+        cloud_mask_cube = get_cube_from_attr(self.cubes, 'omnium_cube_id', 'cloud_mask')
+        lat = cloud_mask_cube.coord('grid_latitude').points
+        lon = cloud_mask_cube.coord('grid_longitude').points
+        dx = lon[1] - lon[0]
+        dy = lat[1] - lat[0]
+        self.NX, self.NY = len(lon), len(lat)
+        self.LX, self.LY = self.NX * dx, self.NY * dy
+
+        # Fail now rather than in org_plot, which needs distances out past LX / 2.
+        cutoff = self.settings.org_dist_cutoff
+        min_cutoff = self.LX / 2 + (self.settings.org_dist_hist_bin_width or 0)
+        if cutoff and cutoff <= min_cutoff:
+            raise ValueError('org_dist_cutoff ({}) must be > LX / 2 + bin width ({})'
+                             .format(cutoff, min_cutoff))
+
     def run(self):
         cubes = self.cubes
 
@@ -44,54 +79,76 @@ class OrgAnalyser(Analyser):
 
         cloud_mask_id = 'cloud_mask'
         cloud_mask_cube = get_cube_from_attr(cubes, 'omnium_cube_id', cloud_mask_id)
-        lat = cloud_mask_cube.coord('grid_latitude').points
-        lon = cloud_mask_cube.coord('grid_longitude').points
-        dx = lon[1] - lon[0]
-        dy = lat[1] - lat[0]
-        self.NX, self.NY = len(lon), len(lat)
-        self.LX, self.LY = self.NX * dx, self.NY * dy
         expts = ExptList(self.suite)
         expts.find([self.task.expt])
         expt_obj = expts.get(self.task.expt)
         assert self.LX == expt_obj.lx and self.LY == expt_obj.ly
         assert self.NX == expt_obj.nx and self.NY == expt_obj.ny
 
-        w_thresh_coord = cloud_mask_cube.coord('w_thres')
-        qcl_thresh_coord = cloud_mask_cube.coord('qcl_thres')
         level_number_coord = cloud_mask_cube.coord('model_level_number')
 
+        min_image = bool(self.settings.org_min_image_dists)
+        hist_bin_width = self.settings.org_dist_hist_bin_width
+        if hist_bin_width:
+            # Use bins that cover every possible distance.
+            if min_image:
+                max_dist = np.sqrt((self.LX / 2)**2 + (self.LY / 2)**2)
+            else:
+                max_dist = np.sqrt((2 * self.LX)**2 + (2 * self.LY)**2)
+            if self.settings.org_dist_cutoff:
+                max_dist = min(max_dist, self.settings.org_dist_cutoff)
+            num_bins = int(np.ceil(max_dist / hist_bin_width))
+            bins = np.arange(num_bins + 1) * hist_bin_width
+
         # level_number refers to orig cube.
         # height_level_index refers to w as it has already picked out the height levels.
         for height_level_index, level_number in enumerate(level_number_coord.points):
-            for thresh_index in range(w_thresh_coord.shape[0]):
+            thresh_pairs = cloud_mask_thresh_pairs(cloud_mask_cube)
+            for thresh_index, (w_thresh, qcl_thresh) in enumerate(thresh_pairs):
                 logger.debug('height_index, thresh_index: {}, {}'.format(height_level_index,
                                                                          thresh_index))
 
-                w_thresh = w_thresh_coord.points[thresh_index]
-                qcl_thresh = qcl_thresh_coord.points[thresh_index]
                 labelled_clouds_cube_id = 'labelled_clouds_z{}_w{}_qcl{}'.format(level_number,
                                                                                  w_thresh,
                                                                                  qcl_thresh)
                 labelled_clouds_cube = get_cube_from_attr(cubes,
                                                           'omnium_cube_id',
                                                           labelled_clouds_cube_id)
-                # N.B. I just take the diagonal indices.
+                # N.B. I just take the diagonal indices (or the threshold_pairs).
                 dists = []
+                if hist_bin_width:
+                    dist_hist = np.zeros(num_bins, dtype=np.int64)
                 total_clouds = 0
 
-                logger.debug('# time indices: {}'.format(cloud_mask_cube.data.shape[0]))
-                for time_index in range(cloud_mask_cube.data.shape[0]):
+                logger.debug('# time indices: {}'.format(cloud_mask_cube.shape[0]))
+                for time_index in range(cloud_mask_cube.shape[0]):
                     # Find each cloud.
-                    labelled_clouds = labelled_clouds_cube[time_index].data.astype(int)
+                    labelled_clouds = labelled_clouds_cube[time_index].data
 
                     cp = self._get_cloud_pos(labelled_clouds)
-                    clouds = [Cloud(cp[j, 0], cp[j, 1]) for j in range(cp.shape[0])]
-                    total_clouds += len(clouds)
+                    total_clouds += len(cp)
                     # Heart of analysis.
-                    new_dists = self._calc_cloud_stats(clouds)
-                    dists.extend(new_dists)
-
-                mean_clouds = total_clouds / cloud_mask_cube.data.shape[0]
+                    new_dists = self._calc_cloud_stats(cp)
+                    if hist_bin_width:
+                        dist_hist += np.histogram(new_dists, bins)[0]
+                    else:
+                        dists.append(new_dists)
+
+                mean_clouds = total_clouds / cloud_mask_cube.shape[0]
+
+                if hist_bin_width:
+                    dist_hist_cube_id = 'dist_hist_z{}_w{}_qcl{}'.format(level_number,
+                                                                         thresh_index,
+                                                                         thresh_index)
+                    dist_hist_cube = self._dist_hist_cube(dist_hist_cube_id, dist_hist, bins)
+                    dist_hist_cube.attributes['dist_hist_key'] = (height_level_index, thresh_index)
+                    dist_hist_cube.attributes['dist_mean_total_clouds'] = (mean_clouds,
+                                                                           total_clouds)
+                    dist_hist_cube.attributes['dist_min_image'] = int(min_image)
+                    self.results[dist_hist_cube_id] = dist_hist_cube
+                    continue
+
+                dists = np.concatenate(dists)
 
                 dist_cube_id = 'dist_z{}_w{}_qcl{}'.format(level_number, thresh_index, thresh_index)
                 values = iris.coords.DimCoord(range(len(dists)), long_name='values')
@@ -102,18 +159,35 @@ class OrgAnalyser(Analyser):
 
                 dist_cube.attributes['dist_key'] = (height_level_index, thresh_index)
                 dist_cube.attributes['dist_mean_total_clouds'] = (mean_clouds, total_clouds)
+                dist_cube.attributes['dist_min_image'] = int(min_image)
                 self.results[dist_cube_id] = dist_cube
 
     def save(self, state, suite):
         self.save_results_cubes(state, suite)
 
-    def display_results(self):
-        dist_cube_id = 'dist_z{}_w{}_qcl{}'.format(18, 1, 1)
-        dists = self.results[dist_cube_id].data
+    @staticmethod
+    def _dist_hist_cube(name, dist_hist, bins):
+        distance = iris.coords.DimCoord((bins[:-1] + bins[1:]) / 2, long_name='distance',
+                                        units='m', bounds=np.array([bins[:-1], bins[1:]]).T)
+        return iris.cube.Cube(dist_hist,
+                              long_name=name,
+                              dim_coords_and_dims=[(distance, 0)],
+                              units='')
 
-        n, bins, patch = plt.hist(dists, 700)
-        #fig = self.plt.figure()
-        plt.clf()
+    def display_results(self):
+        if self.settings.org_dist_hist_bin_width:
+            dist_hist_cube_id = 'dist_hist_z{}_w{}_qcl{}'.format(18, 1, 1)
+            dist_hist_cube = self.results[dist_hist_cube_id]
+            n = dist_hist_cube.data
+            bins = np.append(dist_hist_cube.coord('distance').bounds[:, 0],
+                             dist_hist_cube.coord('distance').bounds[-1, 1])
+        else:
+            dist_cube_id = 'dist_z{}_w{}_qcl{}'.format(18, 1, 1)
+            dists = self.results[dist_cube_id].data
+
+            n, bins, patch = plt.hist(dists, 700)
+            #fig = self.plt.figure()
+            plt.clf()
 
         areas = np.pi * (bins[1:]**2 - bins[:-1]**2)
         cloud_densities = n / areas
@@ -143,40 +217,14 @@ class OrgAnalyser(Analyser):
 
     def _get_cloud_pos(self, clouds):
         "For each cloud, calc its centroid."
-        half_dx = self.LX / (2 * self.NX)
-        half_dy = self.LY / (2 * self.NY)
-        x = np.linspace(half_dx, self.LX - half_dx, self.NX)
-        y = np.linspace(half_dy, self.LY - half_dy, self.NY)
-        X, Y = np.meshgrid(x, y, indexing='xy')
-        cloud_pos = []
-        for i in range(1, clouds.max() + 1):
-            # Averages the x, y coords of all cells with a given index to get each cloud's
-            # "centre of mass", AKA centroid.
-            cloud_x = X[clouds == i].sum() / (clouds == i).sum()
-            cloud_y = Y[clouds == i].sum() / (clouds == i).sum()
-            cloud_pos.append((cloud_x, cloud_y))
-        return np.array(cloud_pos)
-
-    def _calc_min_dists(self, cloud, test_cloud):
-        "Used to calc min distance on cyclic domain."
-        dists = []
-        for ii in [-1, 0, 1]:
-            for jj in [-1, 0, 1]:
-                x = test_cloud.x + ii * self.LX
-                y = test_cloud.y + jj * self.LY
-                dist = np.sqrt((cloud.x - x)**2 + (cloud.y - y)**2)
-                dists.append(dist)
-        return dists
-
-    def _calc_cloud_stats(self, clouds):
+        X, Y = _cell_centre_grids(self.LX, self.LY, self.NX, self.NY)
+        # Averages the x, y coords of all cells with a given index to get each cloud's
+        # "centre of mass", AKA centroid.
+        return cloud_centroids(clouds, X, Y, self.LX, self.LY,
+                               circular=bool(self.settings.org_circular_centroids))
+
+    def _calc_cloud_stats(self, cloud_pos):
         "Calculate the cloud stats of distances between each cloud and each other cloud."
-        dists = []
-        # For each cloud:
-        for i in range(len(clouds)):
-            cloud = clouds[i]
-            # For each other cloud:
-            for j in range(i + 1, len(clouds)):
-                test_cloud = clouds[j]
-                new_dists = self._calc_min_dists(cloud, test_cloud)
-                dists.extend(new_dists)
-        return dists
+        return cloud_distances(cloud_pos, self.LX, self.LY,
+                               min_image=bool(self.settings.org_min_image_dists),
+                               cutoff=self.settings.org_dist_cutoff)
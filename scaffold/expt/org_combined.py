@@ -3,6 +3,7 @@ from collections import defaultdict
 from logging import getLogger
 
 import iris
+import numpy as np
 
 from omnium import Analyser
 
@@ -10,7 +11,9 @@ logger = getLogger('scaf.oc')
 
 
 class OrgCombined(Analyser):
-    """Combines the organizational data for runid >= self.start_runid."""
+    """Combines the organizational data for runid >= self.start_runid.
+
+    Distance histograms (from settings.org_dist_hist_bin_width) are combined by summing them."""
     analysis_name = 'org_combined'
     multi_file = True
     input_dir = 'omnium_output/{version_dir}/{expt}'
@@ -20,6 +23,8 @@ class OrgCombined(Analyser):
 
     def load(self):
         self.dists = defaultdict(list)
+        self.dist_hists = {}
+        self.dist_total_clouds = defaultdict(int)
         for filename in self.task.filenames:
             basename = os.path.basename(filename)
             runid = int(basename.split('.')[1])
@@ -27,13 +32,35 @@ class OrgCombined(Analyser):
                 logger.debug('adding runid: {}'.format(runid))
                 cubes = iris.load(filename)
                 for cube in cubes:
-                    if cube.name()[:4] == 'dist':
+                    if 'dist_hist_key' in cube.attributes:
+                        self._add_dist_hist(cube)
+                    elif cube.name()[:4] == 'dist':
                         (height_level_index, thresh_index) = cube.attributes['dist_key']
                         self.dists[(height_level_index, thresh_index)].extend(cube.data)
             else:
                 logger.debug('skipping runid: {}'.format(runid))
 
+    def _add_dist_hist(self, cube):
+        key = tuple(cube.attributes['dist_hist_key'])
+        self.dist_total_clouds[key] += cube.attributes['dist_mean_total_clouds'][1]
+        if key not in self.dist_hists:
+            self.dist_hists[key] = cube.copy(data=cube.data.astype(np.int64))
+        else:
+            dist_hist = self.dist_hists[key]
+            assert (dist_hist.coord('distance').bounds == cube.coord('distance').bounds).all()
+            dist_hist.data += cube.data
+
     def run(self):
+        for key, dist_hist in self.dist_hists.items():
+            (model_level_number, thresh_index) = key
+
+            dist_hist_cube_id = 'dist_hist_{0}_w{1}_qcl{1}'.format(model_level_number, thresh_index)
+            dist_hist.rename(dist_hist_cube_id)
+            dist_hist.attributes['dist_hist_key'] = key
+            dist_hist.attributes['dist_total_clouds'] = self.dist_total_clouds[key]
+            del dist_hist.attributes['dist_mean_total_clouds']
+            self.results[dist_hist_cube_id] = dist_hist
+
         for key, dists in self.dists.items():
             (model_level_number, thresh_index) = key
 
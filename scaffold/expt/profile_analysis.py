@@ -1,3 +1,5 @@
+import multiprocessing
+from collections import OrderedDict
 from logging import getLogger
 
 import matplotlib
@@ -10,20 +12,63 @@ import iris
 from omnium import Analyser, ExptList
 from omnium.utils import get_cube
 from omnium.consts import Re, cp, g
-from cloud_tracking.utils import label_clds
+
+from scaffold.cloud_utils import count_clds_batch
+from scaffold.level_reader import load_levels
 
 logger = getLogger('scaf.prof_an')
 
 
-def mean(a, axis=None):
-    """Workaround for old versions of numpy, where using axis=tuple on masked_arrays doesn't work.
+def level_masked_sums(data, mask):
+    """Sums and counts of data on each level, where mask is False and where mask is True.
 
-    https://stackoverflow.com/questions/30209624/numpy-mean-used-with-a-tuple-as-axis-argument-not-working-with-a-masked-arr
+    data and mask must be (time, level, lat, lon) arrays. Each level is worked out in one pass.
+    Returns (sums, counts), each with shape (level, 2): [not in mask, in mask] for each level.
+    Sums are done in float64.
     """
-    sums = a.sum(axis=axis)
-    counts = np.logical_not(a.mask).sum(axis=axis)
-    result = sums * 1. / counts
-    return result
+    num_levels = data.shape[1]
+    sums = np.zeros((num_levels, 2))
+    counts = np.zeros((num_levels, 2), dtype=int)
+    for level in range(num_levels):
+        level_mask = np.asarray(mask[:, level]).ravel()
+        sums[level] = np.bincount(level_mask, weights=np.asarray(data[:, level]).ravel(),
+                                  minlength=2)
+        counts[level] = np.bincount(level_mask, minlength=2)
+    return sums, counts
+
+
+def _count_level_clds(level_mask):
+    "Total number of clouds in a (time, lat, lon) mask - for use with multiprocessing."
+    return count_clds_batch(level_mask, diagonal=True).sum()
+
+
+def collapsed_cube(cube, data, collapsed_coords=('time', 'grid_latitude', 'grid_longitude')):
+    """Make a cube from cube and data, with the same metadata as you would get from
+    cube.collapsed(collapsed_coords, MEAN). e.g. a height profile from a (time, height, lat, lon)
+    cube."""
+    collapsed_dims = set()
+    for coord_name in collapsed_coords:
+        collapsed_dims.update(cube.coord_dims(coord_name))
+    index = tuple(0 if dim in collapsed_dims else slice(None) for dim in range(cube.ndim))
+    collapsed = cube[index].copy(data=np.asarray(data, dtype=cube.dtype))
+    # Like cube.collapsed(...), collapse every coord that spans the collapsed dims, e.g.
+    # forecast_period as well as time.
+    for coord in cube.coords():
+        coord_collapsed_dims = tuple(i for i, dim in enumerate(cube.coord_dims(coord))
+                                     if dim in collapsed_dims)
+        if coord_collapsed_dims:
+            collapsed.replace_coord(coord.collapsed(coord_collapsed_dims))
+    collapsed.add_cell_method(iris.coords.CellMethod('mean', coords=list(collapsed_coords)))
+    return collapsed
+
+
+class _CountResult(object):
+    "Already calculated result, with the same interface as multiprocessing's AsyncResult."
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
 
 
 class ProfileAnalyser(Analyser):
@@ -31,6 +76,9 @@ class ProfileAnalyser(Analyser):
 
     Calculates energy lost using pressure from model.
     Calculates *average* profile for all times in the loaded cubes.
+    If settings.profile_time_chunk is set, streams through the input file in chunks of that many
+    time indices, accumulating all profiles, so that memory use does not depend on the number of
+    times in the file.
     """
     analysis_name = 'profile_analysis'
     single_file = True
@@ -52,78 +100,123 @@ class ProfileAnalyser(Analyser):
         expts = ExptList(self.suite)
         expts.find([self.task.expt])
         expt_obj = expts.get(self.task.expt)
-        dx, dy = expt_obj.dx, expt_obj.dy
+        self.dx, self.dy = expt_obj.dx, expt_obj.dy
 
         # u/v profile.
-        u = get_cube(cubes, 0, 2)
-        v = get_cube(cubes, 0, 3)
-        u_profile = u.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        v_profile = v.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.u_heights = u.coord('level_height').points
-
-        self.results['u_profile'] = u_profile
-        self.results['v_profile'] = v_profile
+        self.u = get_cube(cubes, 0, 2)
+        self.v = get_cube(cubes, 0, 3)
+        self.u_heights = self.u.coord('level_height').points
 
         # momentum flux profile.
-        u_inc = get_cube(cubes, 53, 185)
-        v_inc = get_cube(cubes, 53, 186)
-        rho = (get_cube(cubes, 0, 253) / Re ** 2)
-
-        u_inc_ts = u_inc.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        v_inc_ts = v_inc.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        rho_ts = rho.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
+        self.u_inc = get_cube(cubes, 53, 185)
+        self.v_inc = get_cube(cubes, 53, 186)
 
-        theta = get_cube(cubes, 0, 4)
-        qcl = get_cube(cubes, 0, 254)
-        qgr = get_cube(cubes, 0, 273)
-        qcf = get_cube(cubes, 0, 12)
+        self.theta = get_cube(cubes, 0, 4)
+        self.qcl = get_cube(cubes, 0, 254)
+        self.qgr = get_cube(cubes, 0, 273)
+        self.qcf = get_cube(cubes, 0, 12)
 
-        w = get_cube(cubes, 0, 150)
-        rho = get_cube(cubes, 0, 253)
-        pressure = get_cube(cubes, 0, 408)
+        self.w = get_cube(cubes, 0, 150)
+        self.rho = get_cube(cubes, 0, 253)
+        self.pressure = get_cube(cubes, 0, 408)
 
         logger.debug('got cubes of interest')
 
-        w_mask = w.data > self.settings.w_thresh
-        qcl_mask = qcl.data > self.settings.qcl_thresh
-        cloud_mask = w_mask & qcl_mask
+        num_processes = self.settings.profile_num_processes
+        self.pool = None
+        if num_processes and num_processes > 1:
+            self.pool = multiprocessing.Pool(num_processes)
+        try:
+            if self.settings.profile_time_chunk:
+                self._run_time_chunks(self.settings.profile_time_chunk)
+            else:
+                self._run_all_times()
+        finally:
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
 
-        self.results['theta_profile'] = theta.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.results['qcl_profile'] = qcl.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.results['qgr_profile'] = qgr.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.results['qcf_profile'] = qcf.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.results['pressure_profile'] = pressure.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
+        self.calc_energy_loss_rate()
 
-        logger.debug('performed avging')
+    def _run_all_times(self):
+        self._calc_mean_profiles()
+        self._calc_level_profiles()
+
+    def _run_time_chunks(self, time_chunk):
+        """Calc all profiles by streaming through the input file time_chunk time indices at a time.
+
+        Only the data for one chunk is in memory at once, and all profiles are accumulated as
+        sums/counts over the chunks.
+        """
+        filename = self.task.filenames[0]
+        num_times = self.theta.shape[0]
+
+        def load_chunk(cube, time_slice):
+            return load_levels(filename, cube, range(cube.shape[1]), time_slice)
+
+        mean_sums = OrderedDict((name, 0) for name in ['u', 'v', 'qgr', 'qcf', 'pressure'])
+        theta_sums, qcl_sums, counts = 0, 0, 0
+        mf_convs = OrderedDict()
+        num_clouds = OrderedDict()
+        u_inc_ts, v_inc_ts, rho_ts = [], [], []
+
+        for chunk_index, start in enumerate(range(0, num_times, time_chunk)):
+            time_slice = slice(start, min(start + time_chunk, num_times))
+            logger.debug('running time chunk {}: {}'.format(chunk_index, time_slice))
+
+            for name in mean_sums.keys():
+                data = load_chunk(getattr(self, name), time_slice)
+                mean_sums[name] = mean_sums[name] + data.sum(axis=(0, 2, 3), dtype=np.float64)
+
+            w = load_chunk(self.w, time_slice)
+            qcl = load_chunk(self.qcl, time_slice)
+            cloud_mask = (w > self.settings.w_thresh) & (qcl > self.settings.qcl_thresh)
+            chunk_theta_sums, chunk_counts = level_masked_sums(load_chunk(self.theta, time_slice),
+                                                               cloud_mask)
+            theta_sums = theta_sums + chunk_theta_sums
+            qcl_sums = qcl_sums + level_masked_sums(qcl, cloud_mask)[0]
+            counts = counts + chunk_counts
+            del cloud_mask
+
+            rho = load_chunk(self.rho, time_slice) / Re ** 2
+            u_inc_ts.append(load_chunk(self.u_inc, time_slice).mean(axis=(2, 3), dtype=np.float64))
+            v_inc_ts.append(load_chunk(self.v_inc, time_slice).mean(axis=(2, 3), dtype=np.float64))
+            rho_ts.append(rho.mean(axis=(2, 3), dtype=np.float64))
+
+            w_rho_grid = (w[:, :-1] + w[:, 1:]) / 2
+            qcl_rho_grid = (qcl[:, :-1] + qcl[:, 1:]) / 2
+            mf = w_rho_grid * rho
+            for name, mask in self._rho_masks(w_rho_grid, qcl_rho_grid):
+                mf_convs[name] = mf_convs.get(name, 0) + level_masked_sums(mf, mask)[0][:, 1]
+                num_clouds[name] = num_clouds.get(name, 0) + self._count_clouds(mask)
+
+        for name, sums in mean_sums.items():
+            cube = getattr(self, name)
+            self.results[name + '_profile'] = collapsed_cube(cube, sums / (num_times *
+                                                                           cube.shape[2] *
+                                                                           cube.shape[3]))
+        self._set_theta_qcl_profiles(theta_sums, qcl_sums, counts)
+
+        lat_lon = ('grid_latitude', 'grid_longitude')
+        # N.B. rho_ts are already / Re**2: self.rho is only used for its metadata.
+        rho_ts_cube = collapsed_cube(self.rho, np.concatenate(rho_ts), lat_lon)
+        self._set_mom_flux_ts(collapsed_cube(self.u_inc, np.concatenate(u_inc_ts), lat_lon),
+                              collapsed_cube(self.v_inc, np.concatenate(v_inc_ts), lat_lon),
+                              rho_ts_cube)
+        self._set_mf_profiles(mf_convs, num_clouds)
+
+    def _rho_masks(self, w_rho_grid, qcl_rho_grid):
+        # Threshold.
+        w_rho_mask = w_rho_grid > self.settings.w_thresh
+        qcl_rho_mask = qcl_rho_grid > self.settings.qcl_thresh
+        cloud_rho_mask = w_rho_mask & qcl_rho_mask
+        return [('cloud_profile', cloud_rho_mask),
+                ('w_profile', w_rho_mask),
+                ('qcl_profile', qcl_rho_mask)]
 
-        # Make masked arrays to grab subsets of data I want.
-        # N.B. masked where data will be ignored - hence ~cloud_mask.
-        theta_cloud_data = np.ma.array(theta.data, mask=~cloud_mask)
-        theta_not_cloud_data = np.ma.array(theta.data, mask=cloud_mask)
-        qcl_cloud_data = np.ma.array(qcl.data, mask=~cloud_mask)
-        qcl_not_cloud_data = np.ma.array(qcl.data, mask=cloud_mask)
-
-        logger.debug('masked data')
-
-        # Work out theta profiles in/out of clouds.
-        theta_cloud_profile = self.results['theta_profile'].copy()
-        theta_not_cloud_profile = self.results['theta_profile'].copy()
-        # This line caused problems under numpy 1.9.2 - due to axis being tuple.
-        theta_cloud_profile.data = mean(theta_cloud_data, axis=(0, 2, 3)).data
-        theta_not_cloud_profile.data = mean(theta_not_cloud_data, axis=(0, 2, 3)).data
-        self.results['theta_cloud_profile'] = theta_cloud_profile
-        self.results['theta_not_cloud_profile'] = theta_not_cloud_profile
-
-        qcl_cloud_profile = self.results['qcl_profile'].copy()
-        qcl_not_cloud_profile = self.results['qcl_profile'].copy()
-        qcl_cloud_profile.data = mean(qcl_cloud_data, axis=(0, 2, 3)).data
-        qcl_not_cloud_profile.data = mean(qcl_not_cloud_data, axis=(0, 2, 3)).data
-        self.results['qcl_cloud_profile'] = qcl_cloud_profile
-        self.results['qcl_not_cloud_profile'] = qcl_not_cloud_profile
-
-        logger.debug('created masked arrays')
-
-        z = theta.coord('level_height').points
+    def _set_mom_flux_ts(self, u_inc_ts, v_inc_ts, rho_ts):
+        z = self.theta.coord('level_height').points
         dz = z[1:] - z[:-1]
 
         dz_ts = dz.repeat(u_inc_ts.shape[0]).reshape(*u_inc_ts.shape)
@@ -137,46 +230,14 @@ class ProfileAnalyser(Analyser):
         self.results['u_mom_flux_ts'] = u_mom_flux_ts
         self.results['v_mom_flux_ts'] = v_mom_flux_ts
 
-        # mass flux profile.
-        rho.data = rho.data / Re**2
-        rho.units = 'kg m-3'
-        height = rho.coord('level_height').points
-
-        # Interp theta grid vars onto rho grid.
-        w_rho_grid = (w[:, :-1].data + w[:, 1:].data) / 2
-        qcl_rho_grid = (qcl[:, :-1].data + qcl[:, 1:].data) / 2
-
-        # Threshold.
-        w_rho_mask = w_rho_grid > self.settings.w_thresh
-        qcl_rho_mask = qcl_rho_grid > self.settings.qcl_thresh
-        cloud_rho_mask = w_rho_mask & qcl_rho_mask
-
-        # Total mass-flux across domain.
-        mf = w_rho_grid * rho.data
-        # Calc. profiles.
-        # N.B. mf[:, i][cloud_rho_mask[:, i]].sum() is the conv. mass-flux at level i.
-        #mf_cloud_profile_data = np.array([mf[:, i][cloud_rho_mask[:, i]].sum() for i in range(mf.shape[1])])
-        #mf_w_profile_data = np.array([mf[:, i][w_mask[:, i]].sum() for i in range(mf.shape[1])])
-        #mf_qcl_profile_data = np.array([mf[:, i][qcl_rho_mask[:, i]].sum() for i in range(mf.shape[1])])
-
+    def _set_mf_profiles(self, mf_convs, num_clouds):
+        """Mass flux per cloud and number of clouds profiles, from conv. mass flux and # clouds."""
+        height = self.rho.coord('level_height').points
         height_coord = iris.coords.DimCoord(height, long_name='level_height', units='m')
-        for name, mask in [('cloud_profile', cloud_rho_mask),
-                           ('w_profile', w_rho_mask),
-                           ('qcl_profile', qcl_rho_mask)]:
-            logger.debug('running {}'.format(name))
-            profile_data = []
-            cloud_data = []
-
-            # Loop over height.
-            for i in range(mf.shape[1]):
-                mf_conv = mf[:, i][mask[:, i]].sum()
-                num_clouds = 0
-                for itime in range(mf.shape[0]):
-                    num_clouds += label_clds(mask[itime, i], diagonal=True)[0]
-                profile_data.append(mf_conv/num_clouds * dx * dy)
-                cloud_data.append(num_clouds)
-
-            profile_data = np.array(profile_data)
+        for name, mf_conv in mf_convs.items():
+            cloud_data = num_clouds[name]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                profile_data = mf_conv / cloud_data * self.dx * self.dy
             profile_data[np.isnan(profile_data)] = 0
             mf_name = 'mf_' + name
             cloud_name = 'clouds_' + name
@@ -187,7 +248,126 @@ class ProfileAnalyser(Analyser):
                                                       long_name=cloud_name,
                                                       dim_coords_and_dims=[(height_coord, 0)])
 
-        self.calc_energy_loss_rate()
+    def _count_clouds(self, mask):
+        """Number of clouds on each level of a (time, level, lat, lon) mask, summed over time.
+
+        Counts all (time, level) slices in one batch, or if settings.profile_num_processes is set,
+        each level in parallel.
+        """
+        if self.pool:
+            level_masks = [mask[:, i] for i in range(mask.shape[1])]
+            return np.array(self.pool.map(_count_level_clds, level_masks))
+        else:
+            num_clds = count_clds_batch(mask.reshape((-1,) + mask.shape[2:]), diagonal=True)
+            return num_clds.reshape(mask.shape[:2]).sum(axis=0)
+
+    def _count_level_clouds_async(self, level_mask):
+        """Number of clouds in a (time, lat, lon) mask, summed over time. Use .get() for result.
+
+        If settings.profile_num_processes is set, clouds are counted in the background, so
+        that the next level can be worked on at the same time.
+        """
+        if self.pool:
+            return self.pool.apply_async(_count_level_clds, (level_mask,))
+        return _CountResult(_count_level_clds(level_mask))
+
+    def _calc_mean_profiles(self):
+        """Domain mean profiles of u, v, qgr, qcf and pressure.
+
+        Streams through the input file one level at a time.
+        """
+        filename = self.task.filenames[0]
+
+        for name in ['u', 'v', 'qgr', 'qcf', 'pressure']:
+            logger.debug('calc {} profile'.format(name))
+            cube = getattr(self, name)
+            profile_data = np.zeros(cube.shape[1])
+            for level in range(cube.shape[1]):
+                level_data = load_levels(filename, cube, [level])
+                profile_data[level] = level_data.sum(dtype=np.float64) / level_data.size
+            self.results[name + '_profile'] = collapsed_cube(cube, profile_data)
+
+    def _calc_level_profiles(self):
+        """theta/qcl (in/not in cloud), mass flux and # cloud profiles, and momentum flux ts.
+
+        Streams through the input file one level at a time, and works out the sums and counts for
+        all of the profiles for that level in one pass over each variable. w and qcl are
+        interpolated onto each rho level from the theta levels either side of it, so only two
+        levels of them are in memory at once.
+        """
+        filename = self.task.filenames[0]
+        theta, qcl, w, rho = self.theta, self.qcl, self.w, self.rho
+        assert theta.shape == qcl.shape == w.shape
+        num_times, num_levels = theta.shape[:2]
+        num_rho_levels = rho.shape[1]
+        assert num_rho_levels == num_levels - 1
+
+        theta_sums = np.zeros((num_levels, 2))
+        qcl_sums = np.zeros((num_levels, 2))
+        counts = np.zeros((num_levels, 2))
+        mf_convs = OrderedDict()
+        num_clouds = OrderedDict()
+        ts = OrderedDict((name, np.zeros((num_times, num_rho_levels)))
+                         for name in ['u_inc', 'v_inc', 'rho'])
+
+        w_prev, qcl_prev = None, None
+        for level in range(num_levels):
+            logger.debug('calc level {} profiles'.format(level))
+            w_level = load_levels(filename, w, [level])
+            qcl_level = load_levels(filename, qcl, [level])
+            theta_level = load_levels(filename, theta, [level])
+            cloud_mask = (w_level > self.settings.w_thresh) & (qcl_level > self.settings.qcl_thresh)
+
+            theta_sums[level], counts[level] = level_masked_sums(theta_level, cloud_mask)
+            qcl_sums[level] = level_masked_sums(qcl_level, cloud_mask)[0]
+            del theta_level, cloud_mask
+
+            if level > 0:
+                rho_level_index = level - 1
+                rho_level = load_levels(filename, rho, [rho_level_index]) / Re ** 2
+                for name in ['u_inc', 'v_inc']:
+                    ts[name][:, rho_level_index] = load_levels(filename, getattr(self, name),
+                                                               [rho_level_index]).mean(
+                                                                   axis=(1, 2, 3),
+                                                                   dtype=np.float64)
+                ts['rho'][:, rho_level_index] = rho_level.mean(axis=(1, 2, 3), dtype=np.float64)
+
+                # mass flux profile.
+                # Interp theta grid vars onto rho grid.
+                w_rho_grid = (w_prev + w_level) / 2
+                qcl_rho_grid = (qcl_prev + qcl_level) / 2
+                # Total mass-flux across domain.
+                mf = w_rho_grid * rho_level
+                # N.B. mf[mask].sum() is the conv. mass-flux at this level.
+                for name, mask in self._rho_masks(w_rho_grid, qcl_rho_grid):
+                    mf_convs.setdefault(name, np.zeros(num_rho_levels))
+                    num_clouds.setdefault(name, [None] * num_rho_levels)
+                    mf_convs[name][rho_level_index] = level_masked_sums(mf, mask)[0][0, 1]
+                    num_clouds[name][rho_level_index] = self._count_level_clouds_async(mask[:, 0])
+                del w_rho_grid, qcl_rho_grid, mf
+            w_prev, qcl_prev = w_level, qcl_level
+
+        self._set_theta_qcl_profiles(theta_sums, qcl_sums, counts)
+        logger.debug('performed avging')
+
+        lat_lon = ('grid_latitude', 'grid_longitude')
+        self._set_mom_flux_ts(collapsed_cube(self.u_inc, ts['u_inc'], lat_lon),
+                              collapsed_cube(self.v_inc, ts['v_inc'], lat_lon),
+                              collapsed_cube(self.rho, ts['rho'], lat_lon))
+        num_clouds = OrderedDict((name, np.array([result.get() for result in results]))
+                                 for name, results in num_clouds.items())
+        self._set_mf_profiles(mf_convs, num_clouds)
+
+    def _set_theta_qcl_profiles(self, theta_sums, qcl_sums, counts):
+        for name, cube, sums in [('theta', self.theta, theta_sums), ('qcl', self.qcl, qcl_sums)]:
+            # N.B. nan if there are no cells in/not in cloud on a level.
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.results[name + '_profile'] = collapsed_cube(cube, sums.sum(axis=1) /
+                                                                 counts.sum(axis=1))
+                self.results[name + '_cloud_profile'] = collapsed_cube(cube,
+                                                                       sums[:, 1] / counts[:, 1])
+                self.results[name + '_not_cloud_profile'] = collapsed_cube(cube, sums[:, 0] /
+                                                                           counts[:, 0])
 
     def save(self, state, suite):
         self.save_results_cubes(state, suite)
@@ -1,3 +1,5 @@
+import json
+from collections import OrderedDict
 from logging import getLogger
 
 import iris
@@ -10,8 +12,58 @@ from omnium.utils import get_cube
 logger = getLogger('scaf.restart')
 
 
+def mse_terms(rho_data, th_data, ep_data, q_data, rho_heights):
+    """Calculate the T, q and z terms of Moist Static Energy on rho levels.
+
+    rho_data and rho_heights are on rho levels, th_data, ep_data and q_data on theta levels
+    (one more level). Arrays are (level, lat, lon). Uses broadcasting and in-place ops to avoid
+    full size temporaries. The outputs are allocated with the dtype that
+    rho_data * (th_data[:-1] + th_data[1:]) / 2 * ep_data[:-1] * cp etc. would have, so e.g. float64
+    rho with float32 theta gives float64 terms. N.B. e_z has the dtype of
+    rho_heights * rho_data, as before.
+    """
+    e_t = np.empty(th_data[:-1].shape, np.result_type(rho_data, th_data, ep_data))
+    np.add(th_data[:-1], th_data[1:], out=e_t)
+    e_t *= rho_data
+    e_t /= 2
+    e_t *= ep_data[:-1]
+    e_t *= cp
+
+    e_q = np.empty(q_data[:-1].shape, np.result_type(rho_data, q_data))
+    np.add(q_data[:-1], q_data[1:], out=e_q)
+    e_q *= rho_data
+    e_q /= 2
+    e_q *= L
+
+    e_z = rho_data * g * rho_heights[:, None, None]
+    return e_t, e_q, e_z
+
+
+def column_data(cube, columns=None):
+    """Data for cube, or if columns ((y indices, x indices)) is given, only for those columns.
+
+    cube is (level, lat, lon), the columns' data is (level, num_columns). If cube's data is lazy,
+    it is read one level at a time and only the columns are kept, so the full cube's data is
+    never in memory (and the cube stays lazy).
+    """
+    if columns is None:
+        return cube.data
+    elif not cube.has_lazy_data():
+        return cube.data[(slice(None),) + tuple(columns)]
+    ys, xs = columns
+    return np.array([cube[level].data[ys, xs] for level in range(cube.shape[0])])
+
+
 class RestartDumpAnalyser(Analyser):
-    """Performs some sanity checks, calcs MSE, TCW."""
+    """Performs some sanity checks, calcs MSE, TCW.
+
+    If settings.restart_dump_mse_profile_only is set, MSE is calculated one level at a time and
+    only its profile (and total) are kept, not the full 3D MSE cubes.
+
+    settings.restart_dump_validation controls the sanity checks: 'off', 'sampled' (only check
+    settings.restart_dump_validation_columns random columns) or 'full'. The results of the checks
+    are saved as a JSON validation report next to the output file.
+    """
     analysis_name = 'restart_dump_analysis'
     single_file = True
     input_dir = 'share/data/history/{expt}'
@@ -48,10 +100,7 @@ class RestartDumpAnalyser(Analyser):
         self.qvars = [self.q, self.qcl, self.qcf, self.qrain, self.qgraup]
         self.mvars = [self.m, self.mcl, self.mcf, self.mrain, self.mgraup]
 
-        logger.debug('running _sanity_check_water_species')
-        self._sanity_check_water_species(self.qvars, self.mvars)
-        logger.debug('running _sanity_wv_density')
-        self._sanity_check_wv_density(self.rho, self.rho_d, self.q, self.m)
+        self._validate()
 
         logger.debug('running _calc_tcw')
         self._calc_tcw(self.rho, self.qvars)
@@ -60,12 +109,55 @@ class RestartDumpAnalyser(Analyser):
 
     def save(self, state, suite):
         self.save_results_cubes(state, suite)
+        with open(self.task.output_filenames[0] + '.validation.json', 'w') as f:
+            json.dump(self.validation_report, f, indent=2)
+
+    def _validate(self):
+        """Perform sanity checks at settings.restart_dump_validation level, build report."""
+        level = self.settings.restart_dump_validation
+        self.validation_report = OrderedDict([('level', level), ('checks', [])])
+        if level == 'off':
+            return
+        elif level == 'sampled':
+            # Only pick out some (reproducible) columns. Each field is read a level at a time and
+            # only these columns are kept, to bound memory.
+            _, ny, nx = self.q.shape
+            num_columns = min(self.settings.restart_dump_validation_columns, ny * nx)
+            rng = np.random.RandomState(int(self.task.runid))
+            columns = np.unravel_index(rng.choice(ny * nx, num_columns, replace=False), (ny, nx))
+            self.validation_report['num_columns'] = int(num_columns)
+        elif level == 'full':
+            columns = None
+        else:
+            raise ValueError('unrecognised validation level: {}'.format(level))
+
+        logger.debug('running _sanity_check_water_species')
+        self._sanity_check_water_species(self.qvars, self.mvars, columns)
+        logger.debug('running _sanity_wv_density')
+        self._sanity_check_wv_density(self.rho, self.rho_d, self.q, self.m, columns)
+
+        failed = [check for check in self.validation_report['checks'] if check['passed'] is False]
+        if failed:
+            logger.warning('{} validation check(s) failed'.format(len(failed)))
 
     def _create_cube(self, archetype, data, name, units):
-        cube = archetype.copy()
+        # N.B. copy(data=...) avoids copying archetype's data.
+        cube = archetype.copy(data=data)
+        cube.rename(name)
+        cube.units = units
+        return cube
+
+    @staticmethod
+    def _create_profile_cube(archetype, data, name, units):
+        """Make a height profile cube from data, with the same metadata as you would get from
+        archetype.collapsed(['grid_latitude', 'grid_longitude'], MEAN)."""
+        collapsed_coords = ['grid_latitude', 'grid_longitude']
+        cube = archetype[:, 0, 0].copy(data=np.asarray(data))
+        for coord_name in collapsed_coords:
+            cube.replace_coord(archetype.coord(coord_name).collapsed())
+        cube.add_cell_method(iris.coords.CellMethod('mean', coords=collapsed_coords))
         cube.rename(name)
         cube.units = units
-        cube.data = data
         return cube
 
     def _calc_mse(self, rho, th, ep, q):
@@ -73,6 +165,7 @@ class RestartDumpAnalyser(Analyser):
 
         rho, th(eta), ep (Exner Pressure) and q must be 3D fields
         returns 3D MSE, stores all working in object.
+        If settings.restart_dump_mse_profile_only is set, returns the MSE profile instead.
         """
         self.results['theta'] = th
         for coord in th.coords():
@@ -88,25 +181,41 @@ class RestartDumpAnalyser(Analyser):
         height_delta = iris.cube.Cube(dz, long_name='height_delta', dim_coords_and_dims=[(dz_heights, 0)], units='m')
 
         Lv_rho_heights = rho.coord(height_name).points
-        Lv_rho = Lv_rho_heights.repeat(rho.shape[1] * rho.shape[2]).reshape(rho.shape[0], rho.shape[1], rho.shape[2])
-        self.e_t = rho.data * (th[:-1, :, :].data + th[1:, :, :].data) / 2 * ep[:-1].data * cp
-        self.e_q = rho.data * (q[:-1, :, :].data + q[1:, :, :].data) / 2 * L
-        self.e_z = rho.data * g * Lv_rho
-
-        self.mse_data = (self.e_t + self.e_q + self.e_z)
-        self.mse = self._create_cube(rho, self.mse_data, 'Moist Static Energy', 'J m-3')
-
-        self.results['MSE'] = self.mse
-        self.results['MSE_T'] = self._create_cube(rho, self.e_t, 'Moist Static Energy (T term)', 'J m-3')
-        self.results['MSE_Q'] = self._create_cube(rho, self.e_q, 'Moist Static Energy (Q term)', 'J m-3')
-        self.results['MSE_Z'] = self._create_cube(rho, self.e_z, 'Moist Static Energy (Z term)', 'J m-3')
-
-        self.e_t_profile = self.e_t.mean(axis=(1, 2))
-        self.e_q_profile = self.e_q.mean(axis=(1, 2))
-        self.e_z_profile = self.e_z.mean(axis=(1, 2))
-
-        self.mse_profile = self.mse.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.mse_profile.rename('MSE profile')
+        if self.settings.restart_dump_mse_profile_only:
+            # Work through one level at a time, only keeping the profiles.
+            profiles = np.zeros((rho.shape[0], 4))
+            for i in range(rho.shape[0]):
+                e_t, e_q, e_z = mse_terms(rho[i:i + 1].data, th[i:i + 2].data, ep[i:i + 1].data,
+                                          q[i:i + 2].data, Lv_rho_heights[i:i + 1])
+                profiles[i] = e_t.mean(), e_q.mean(), e_z.mean(), (e_t + e_q + e_z).mean()
+            self.e_t_profile, self.e_q_profile, self.e_z_profile = profiles[:, :3].T
+            self.mse_profile = self._create_profile_cube(rho, profiles[:, 3], 'MSE profile',
+                                                         'J m-3')
+        else:
+            self.e_t, self.e_q, self.e_z = mse_terms(rho.data, th.data, ep.data, q.data,
+                                                     Lv_rho_heights)
+
+            # Same as e_t + e_q + e_z, but without the temporary.
+            self.mse_data = np.empty(self.e_t.shape, np.result_type(self.e_t, self.e_q, self.e_z))
+            np.add(self.e_t, self.e_q, out=self.mse_data)
+            self.mse_data += self.e_z
+            self.mse = self._create_cube(rho, self.mse_data, 'Moist Static Energy', 'J m-3')
+
+            self.results['MSE'] = self.mse
+            self.results['MSE_T'] = self._create_cube(rho, self.e_t,
+                                                      'Moist Static Energy (T term)', 'J m-3')
+            self.results['MSE_Q'] = self._create_cube(rho, self.e_q,
+                                                      'Moist Static Energy (Q term)', 'J m-3')
+            self.results['MSE_Z'] = self._create_cube(rho, self.e_z,
+                                                      'Moist Static Energy (Z term)', 'J m-3')
+
+            self.e_t_profile = self.e_t.mean(axis=(1, 2))
+            self.e_q_profile = self.e_q.mean(axis=(1, 2))
+            self.e_z_profile = self.e_z.mean(axis=(1, 2))
+
+            self.mse_profile = self.mse.collapsed(['grid_latitude', 'grid_longitude'],
+                                                  iris.analysis.MEAN)
+            self.mse_profile.rename('MSE profile')
         self.results['mse_profile'] = self.mse_profile
 
         self.total_mse_data = (self.mse_profile.data * height_delta.data).sum()
@@ -120,6 +229,8 @@ class RestartDumpAnalyser(Analyser):
         logger.info('  E(T) [GJ m^-2] = {0:.5f}'.format((self.e_t_profile * dz).sum() / 1e9))
         logger.info('  E(q) [GJ m^-2] = {0:.5f}'.format((self.e_q_profile * dz).sum() / 1e9))
         logger.info('  E(z) [GJ m^-2] = {0:.5f}'.format((self.e_z_profile * dz).sum() / 1e9))
+        if self.settings.restart_dump_mse_profile_only:
+            return self.mse_profile
         return self.mse
 
     def _calc_mwvi(self, rho, var):
@@ -197,21 +308,42 @@ class RestartDumpAnalyser(Analyser):
         logger.info('Total col water (kg m-2/mm): {}'.format(self.tcw))
         return self.tcw
 
-    def _sanity_check_water_species(self, qvars, mvars):
-        """Perform a check to make sure that spec. humidity/mixing ratio rel. holds."""
-        msum = np.zeros_like(mvars[0].data)
-        for mv in mvars:
-            msum += mv.data
-
-        for qv, mv in zip(qvars, mvars):
-            logger.info(qv.name())
-            diff = np.abs((mv.data / (1 + msum)) - qv.data)
-            logger.info('Max diff: {}'.format(diff.max()))
-            if diff.max() > 1e-15:
-                logger.info('MAX DIFF TOO LARGE')
-
-    def _sanity_check_wv_density(self, rho, rho_d, q, m):
-        q_rho = (q.data[:-1, :, :] + q.data[1:, :, :]) / 2
-        m_rho = (m.data[:-1, :, :] + m.data[1:, :, :]) / 2
-
-        logger.info('max diff rho_d * m, rho * q: {}'.format(np.abs(rho_d.data * m_rho - rho.data * q_rho).max()))
+    def _sanity_check_water_species(self, qvars, mvars, columns=None):
+        """Perform a check to make sure that spec. humidity/mixing ratio rel. holds.
+
+        If columns is given, only checks those columns (see column_data)."""
+        mdata = [column_data(mv, columns) for mv in mvars]
+        msum = np.zeros_like(mdata[0])
+        for data in mdata:
+            msum += data
+        msum += 1
+
+        tolerance = 1e-15
+        for qv, data in zip(qvars, mdata):
+            max_diff = float(np.abs((data / msum) - column_data(qv, columns)).max())
+            self.validation_report['checks'].append(OrderedDict([
+                ('check', 'water_species'),
+                ('name', qv.name()),
+                ('max_diff', max_diff),
+                ('tolerance', tolerance),
+                ('passed', max_diff <= tolerance),
+            ]))
+
+    def _sanity_check_wv_density(self, rho, rho_d, q, m, columns=None):
+        """Check that rho_d * m == rho * q, on rho levels.
+
+        If columns is given, only checks those columns (see column_data)."""
+        q_data = column_data(q, columns)
+        m_data = column_data(m, columns)
+        q_rho = (q_data[:-1] + q_data[1:]) / 2
+        m_rho = (m_data[:-1] + m_data[1:]) / 2
+
+        max_diff = float(np.abs(column_data(rho_d, columns) * m_rho -
+                                column_data(rho, columns) * q_rho).max())
+        # N.B. no tolerance, max_diff is just reported.
+        self.validation_report['checks'].append(OrderedDict([
+            ('check', 'wv_density'),
+            ('name', 'rho_d * m - rho * q'),
+            ('max_diff', max_diff),
+            ('passed', None),
+        ]))
@@ -1,4 +1,7 @@
+import multiprocessing
 import os
+import pickle
+from collections import OrderedDict
 from logging import getLogger
 
 import iris
@@ -19,30 +22,97 @@ from omnium import Analyser
 from omnium.consts import kappa, p_ref
 from omnium.utils import get_cube
 
+from scaffold.utils import wind_shear_between_levels
+from scaffold.version import get_version
+
 logger = getLogger('scaf.rdsa')
 if not has_metpy:
     logger.warning('metpy not available')
 
 
-def max_wind_diff_between_levels(u_profile, v_profile, start_level, end_level):
-    max_wind_diff, max_i, max_j = 0, 0, 0
-    # i is lower (higher pressure).
-    for i in range(start_level, end_level - 1):
-        for j in range(i + 1, end_level):
-            wind_diff = np.sqrt((u_profile[i] - u_profile[j])**2 +
-                                (v_profile[i] - v_profile[j])**2)
-            # v. low level debug to check it's doing right thing.
-            # logger.debug('diff {} - {} hPa: {}',
-            #              pressure[i], pressure[j], wind_diff)
-            if wind_diff > max_wind_diff:
-                max_wind_diff = wind_diff
-                max_i, max_j = i, j
-    return max_wind_diff, max_i, max_j
+def calc_thermodynamic_summary_info(runid, dump):
+    "Thermodynamic summary row for one dump: runid, Tsurf, LCL, LFC, LNB, CAPE, CIN."
+    theta = get_cube(dump, 0, 4)
+    exnerp = get_cube(dump, 0, 255)
+    qv = get_cube(dump, 0, 10)
 
+    qvdata = qv.data
 
-class RestartDumpSummaryInfo(Analyser):
+    Tdata = theta.data * exnerp.data
+    pdata = exnerp.data ** (1 / kappa) * p_ref
+
+    p = pdata * units('Pa')
+    qv = qvdata * units('kg/kg')
+    T = Tdata * units('K')
+    Td = mpcalc.dewpoint_from_specific_humidity(qv, T, p)
+
+    p_profile = p.mean(axis=(1, 2))
+    T_profile = T.mean(axis=(1, 2))
+    Td_profile = Td.mean(axis=(1, 2))
+
+    cape, cin = mpcalc.surface_based_cape_cin(p_profile, T_profile, Td_profile)
+    lcl = mpcalc.lcl(p_profile[0], T_profile[0], Td_profile[0])
+    lfc = mpcalc.lfc(p_profile, T_profile, Td_profile)
+    lnb = mpcalc.el(p_profile, T_profile, Td_profile)
+
+    # logger.info(lfc)
+    # logger.info(mpcalc.pressure_to_height_std(lfc[0]))
+    return [runid,
+            T_profile[0].magnitude,
+            lcl[0].magnitude,
+            lfc[0].magnitude,
+            lnb[0].magnitude,
+            cape.magnitude,
+            cin.magnitude]
+
+
+def dump_wind_profiles(dump):
+    "Domain mean u, v profiles for one dump, and the heights of their levels."
+    u = get_cube(dump, 0, 2)
+    v = get_cube(dump, 0, 3)
+    u_profile = u.data.mean(axis=(1, 2))
+    v_profile = v.data.mean(axis=(1, 2))
+    z = u.coord('atmosphere_hybrid_height_coordinate').points
+    return u_profile, v_profile, z
+
+
+def calc_LLS_MLS(runids, u_profiles, v_profiles, z):
+    """Dynamic summary rows for a stack of (dump, level) profiles, all worked out in one go.
+
+    Each row is: runid, mean_surf_wind, LLWD, LLS, MLWD, MLS.
     """
+    mean_surf_wind = np.sqrt(u_profiles[:, 0]**2 + v_profiles[:, 0]**2)
+    # Level 17 == 800 hPa
+    llwd, _, _, lls = wind_shear_between_levels(u_profiles, v_profiles, z, 0, 17)
+    # Level 33 == 500 hPa
+    mlwd, _, _, mls = wind_shear_between_levels(u_profiles, v_profiles, z, 17, 33)
+    return [list(row) for row in zip(runids, mean_surf_wind, llwd, lls, mlwd, mls)]
+
+
+def summarise_dump(runid_filename):
+    """Load one dump and calc its thermodynamic summary row and its wind profiles.
 
+    Module level (and only returns the row/profiles) so it can be used with multiprocessing.
+    """
+    runid, filename = runid_filename
+    logger.debug('summarising runid: {}'.format(runid))
+    dump = iris.load(filename)
+    return calc_thermodynamic_summary_info(runid, dump), dump_wind_profiles(dump)
+
+
+class RestartDumpSummaryInfo(Analyser):
+    """Calcs thermodynamic (CAPE, CIN etc.) and dynamic (wind shear) summary info for each dump.
+
+    If settings.restart_dump_num_processes is set, the dumps are summarised in parallel using this
+    many processes, each of which loads one dump at a time. The wind shear summary info is then
+    calculated for all dumps at once.
+
+    If settings.restart_dump_use_cache is set, each dump's summary is cached in a pickle next to
+    the output file, keyed on the dump's path, size and mtime. The per-dump summaries do not
+    depend on any settings, so the whole cache is only discarded if it was made by another
+    scaffold version. On a rerun, only new or changed dumps are summarised, and dumps that are
+    no longer selected are dropped from the cache. N.B. the cache file is not one of the
+    output_filenames, so omnium does not track it: it is off by default.
     """
     analysis_name = 'restart_dump_summary_info'
     multi_file = True
@@ -52,24 +122,61 @@ class RestartDumpSummaryInfo(Analyser):
     output_filenames = ['{output_dir}/atmos.restart_dump_summary_info.hdf']
 
     def load(self):
-        self.dumps = {}
+        # N.B. dumps are loaded one at a time when they are summarised.
+        self.dump_filenames = OrderedDict()
         for filename in self.task.filenames:
             basename = os.path.basename(filename)
             runid = int(basename[9:12])
             if self.settings.start_runid < runid <= self.settings.end_runid:
                 logger.debug('adding runid: {}'.format(runid))
-                dump = iris.load(filename)
-                self.dumps[runid] = dump
+                self.dump_filenames[runid] = filename
             else:
                 logger.debug('skipping runid: {}'.format(runid))
 
     def run(self):
-        self.summary_info_data = []
-        self.dyn_summary_info_data = []
-
-        for runid, dump in self.dumps.items():
-            self._calc_thermodynamic_summary_info(runid, dump)
-            self._calc_LLS_MLS(runid, dump)
+        if self.settings.restart_dump_use_cache:
+            self.cache = self._load_cache()
+        else:
+            self.cache = None
+
+        dump_ids = OrderedDict((runid, self._dump_id(filename))
+                               for runid, filename in self.dump_filenames.items())
+        uncached_items = [(runid, filename) for runid, filename in self.dump_filenames.items()
+                          if not self._is_cached(filename, dump_ids[runid])]
+        logger.debug('summarising {} of {} dumps'.format(len(uncached_items),
+                                                         len(self.dump_filenames)))
+
+        num_processes = self.settings.restart_dump_num_processes
+        if num_processes and num_processes > 1 and len(uncached_items) > 1:
+            with multiprocessing.Pool(num_processes) as pool:
+                new_rows = pool.map(summarise_dump, uncached_items, chunksize=1)
+        else:
+            new_rows = [summarise_dump(item) for item in uncached_items]
+
+        if self.cache is not None:
+            for (runid, filename), new_row in zip(uncached_items, new_rows):
+                self.cache['dumps'][filename] = (dump_ids[runid], new_row)
+            # Drop dumps that are no longer selected, so the cache does not grow without bound.
+            filenames = set(self.dump_filenames.values())
+            for filename in list(self.cache['dumps'].keys()):
+                if filename not in filenames:
+                    del self.cache['dumps'][filename]
+            rows = [self.cache['dumps'][filename][1] for filename in self.dump_filenames.values()]
+        else:
+            rows = new_rows
+
+        self.summary_info_data = [summary_info for summary_info, _ in rows]
+
+        # Dynamic summary info for all dumps is calculated in one go from the stacked profiles.
+        runids = list(self.dump_filenames.keys())
+        if rows:
+            u_profiles = np.array([u_profile for _, (u_profile, _, _) in rows])
+            v_profiles = np.array([v_profile for _, (_, v_profile, _) in rows])
+            z = rows[0][1][2]
+            assert all((dump_z == z).all() for _, (_, _, dump_z) in rows)
+            self.dyn_summary_info_data = calc_LLS_MLS(runids, u_profiles, v_profiles, z)
+        else:
+            self.dyn_summary_info_data = []
 
         self.df_summary_info = pd.DataFrame(self.summary_info_data,
                                             columns=['runid', 'Tsurf',
@@ -79,56 +186,41 @@ class RestartDumpSummaryInfo(Analyser):
                                                 columns=['runid', 'mean_surf_wind',
                                                          'LLWD', 'LLS', 'MLWD', 'MLS'])
 
-    def _calc_thermodynamic_summary_info(self, runid, dump):
-        theta = get_cube(dump, 0, 4)
-        exnerp = get_cube(dump, 0, 255)
-        qv = get_cube(dump, 0, 10)
-
-        qvdata = qv.data
-
-        Tdata = theta.data * exnerp.data
-        pdata = exnerp.data ** (1 / kappa) * p_ref
-
-        p = pdata * units('Pa')
-        qv = qvdata * units('kg/kg')
-        T = Tdata * units('K')
-        Td = mpcalc.dewpoint_from_specific_humidity(qv, T, p)
-
-        p_profile = p.mean(axis=(1, 2))
-        T_profile = T.mean(axis=(1, 2))
-        Td_profile = Td.mean(axis=(1, 2))
-
-        cape, cin = mpcalc.surface_based_cape_cin(p_profile, T_profile, Td_profile)
-        lcl = mpcalc.lcl(p_profile[0], T_profile[0], Td_profile[0])
-        lfc = mpcalc.lfc(p_profile, T_profile, Td_profile)
-        lnb = mpcalc.el(p_profile, T_profile, Td_profile)
-
-        # logger.info(lfc)
-        # logger.info(mpcalc.pressure_to_height_std(lfc[0]))
-        self.summary_info_data.append([runid,
-                                       T_profile[0].magnitude,
-                                       lcl[0].magnitude,
-                                       lfc[0].magnitude,
-                                       lnb[0].magnitude,
-                                       cape.magnitude,
-                                       cin.magnitude])
-
-    def _calc_LLS_MLS(self, runid, dump):
-        u = get_cube(dump, 0, 2)
-        v = get_cube(dump, 0, 3)
-        u_profile = u.data.mean(axis=(1, 2))
-        v_profile = v.data.mean(axis=(1, 2))
-        z = u.coord('atmosphere_hybrid_height_coordinate').points
-
-        mean_surf_wind = np.sqrt(u_profile[0]**2 + v_profile[0]**2)
-        # Level 17 == 800 hPa
-        llwd, lli, llj = max_wind_diff_between_levels(u_profile, v_profile, 0, 17)
-        # Level 33 == 500 hPa
-        mlwd, mli, mlj = max_wind_diff_between_levels(u_profile, v_profile, 17, 33)
-        self.dyn_summary_info_data.append([runid, mean_surf_wind,
-                                           llwd, llwd / (z[llj] - z[lli]),
-                                           mlwd, mlwd / (z[mlj] - z[mli])])
-
     def save(self, state, suite):
         self.df_summary_info.to_hdf(self.task.output_filenames[0], 'thermodynamic_summary')
         self.df_dyn_summary_info.to_hdf(self.task.output_filenames[0], 'dynamic_summary')
+        if self.cache is not None:
+            with open(self._cache_filename(), 'wb') as f:
+                pickle.dump(self.cache, f)
+
+    def _cache_filename(self):
+        return self.task.output_filenames[0] + '.cache.pkl'
+
+    def _cache_key(self):
+        # N.B. not keyed on settings: each dump's summary only depends on the dump itself.
+        return get_version('long')
+
+    def _load_cache(self):
+        "Load cached dump summaries, or start a new cache if missing or made by another version."
+        cache_filename = self._cache_filename()
+        if os.path.exists(cache_filename):
+            try:
+                with open(cache_filename, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache['key'] == self._cache_key():
+                    logger.debug('using cache: {}'.format(cache_filename))
+                    return cache
+                logger.debug('cache made with other version: {}'.format(cache_filename))
+            except Exception as e:
+                logger.warning('could not load cache {}: {}'.format(cache_filename, e))
+        return {'key': self._cache_key(), 'dumps': {}}
+
+    @staticmethod
+    def _dump_id(filename):
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
+
+    def _is_cached(self, filename, dump_id):
+        if self.cache is None or filename not in self.cache['dumps']:
+            return False
+        return self.cache['dumps'][filename][0] == dump_id
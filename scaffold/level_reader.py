@@ -0,0 +1,46 @@
+from logging import getLogger
+
+import netCDF4
+import numpy as np
+
+logger = getLogger('scaf.level_reader')
+
+
+def load_levels(filename, cube, levels, time_slice=slice(None)):
+    """Load only the given model levels (and times) of cube's data directly from a NetCDF file.
+
+    cube must be a lazily loaded (i.e. data not yet touched) 4D (time, model_level_number,
+    grid_latitude, grid_longitude) cube that was loaded from filename, e.g. one of the cubes from
+    self.load_cubes() picked out using omnium.utils.get_cube. Its var_name is used to find the
+    NetCDF variable to read.
+
+    Each level is read as a separate hyperslab, so only the data for the requested levels is read
+    (and decompressed, if the file is compressed), and the returned array is the only full-size
+    array that is allocated. Peak memory scales with len(levels), not with the number of levels
+    in the file.
+
+    Returns array with shape (time, len(levels), lat, lon).
+    """
+    assert cube.ndim == 4
+    with netCDF4.Dataset(filename, 'r') as dataset:
+        # Only return masked arrays if there are any masked values.
+        dataset.set_always_mask(False)
+        var = dataset.variables[cube.var_name]
+        assert var.shape == cube.shape, 'var/cube shape mismatch: {}'.format(var.name)
+        data = None
+        mask = None
+        for level_index, level in enumerate(levels):
+            logger.debug('loading {} level {}'.format(var.name, level))
+            level_data = var[time_slice, level]
+            if data is None:
+                data = np.empty((level_data.shape[0], len(levels)) + level_data.shape[1:],
+                                dtype=level_data.dtype)
+            if np.ma.is_masked(level_data):
+                if mask is None:
+                    mask = np.zeros(data.shape, dtype=bool)
+                mask[:, level_index] = np.ma.getmaskarray(level_data)
+            data[:, level_index] = np.ma.getdata(level_data)
+
+    if mask is not None:
+        data = np.ma.array(data, mask=mask)
+    return data
@@ -6,6 +6,40 @@ production_settings = AnalysisSettings(dict(
     height_levels = [15, 17, 19],
     qcl_threshs=[4.5e-6,5e-6,5.5e-6],
     w_threshs=[0.9,1.,1.1],
+    # If set, only use these (w_thresh, qcl_thresh) pairs instead of all combinations of w_threshs
+    # and qcl_threshs, e.g. [(0.9, 4.5e-6), (1., 5e-6), (1.1, 5.5e-6)].
+    threshold_pairs=None,
+    # If set, process each file in chunks of this many time indices to bound memory use.
+    cloud_analysis_time_chunk=None,
+    # If set, org_analysis only uses the distance to the nearest image of each other cloud.
+    org_min_image_dists=False,
+    # If set, org_analysis saves a histogram of distances with bins of this width (m), not the
+    # distances themselves.
+    org_dist_hist_bin_width=None,
+    # If set, org_analysis only finds cloud-cloud distances <= this (m). Must be > LX / 2, plus
+    # org_dist_hist_bin_width if that is set.
+    org_dist_cutoff=None,
+    # If set, org_analysis uses circular mean centroids (correct for clouds crossing the boundary).
+    org_circular_centroids=False,
+    # If set, mass_flux_spatial_scales_analysis uses these numbers of subdomains (across the
+    # domain) instead of powers of 2 up to npow.
+    mass_flux_spatial_ns=None,
+    # If set (with mass_flux_spatial_ns), use overlapping subdomains starting at every grid cell.
+    mass_flux_spatial_sliding=False,
+    # If set, profile_analysis counts clouds on each level in parallel using this many processes.
+    profile_num_processes=None,
+    # If set, process each pp2 file in chunks of this many time indices to bound memory use.
+    profile_time_chunk=None,
+    # If set, restart_dump_summary_info summarises dumps in parallel using this many processes.
+    restart_dump_num_processes=None,
+    # Cache restart_dump_summary_info results for each dump, so only new/changed dumps are rerun.
+    # N.B. the cache (<output>.cache.pkl) is not an omnium output: delete it to force a rerun.
+    restart_dump_use_cache=False,
+    # If set, restart_dump_analysis only keeps MSE profiles (and totals), not full 3D MSE cubes.
+    restart_dump_mse_profile_only=False,
+    # restart_dump_analysis sanity checks: 'off', 'sampled' (random columns) or 'full'.
+    restart_dump_validation='sampled',
+    restart_dump_validation_columns=1000,
     # mass_flux_spatial_scales_analysis
     npow=4,
     # profile_analysis
@@ -26,6 +60,40 @@ test_settings = AnalysisSettings(dict(
     height_levels = [15, 17, 19],
     qcl_threshs=[4.5e-6,5e-6,5.5e-6],
     w_threshs=[0.9,1.,1.1],
+    # If set, only use these (w_thresh, qcl_thresh) pairs instead of all combinations of w_threshs
+    # and qcl_threshs, e.g. [(0.9, 4.5e-6), (1., 5e-6), (1.1, 5.5e-6)].
+    threshold_pairs=None,
+    # If set, process each file in chunks of this many time indices to bound memory use.
+    cloud_analysis_time_chunk=None,
+    # If set, org_analysis only uses the distance to the nearest image of each other cloud.
+    org_min_image_dists=False,
+    # If set, org_analysis saves a histogram of distances with bins of this width (m), not the
+    # distances themselves.
+    org_dist_hist_bin_width=None,
+    # If set, org_analysis only finds cloud-cloud distances <= this (m). Must be > LX / 2, plus
+    # org_dist_hist_bin_width if that is set.
+    org_dist_cutoff=None,
+    # If set, org_analysis uses circular mean centroids (correct for clouds crossing the boundary).
+    org_circular_centroids=False,
+    # If set, mass_flux_spatial_scales_analysis uses these numbers of subdomains (across the
+    # domain) instead of powers of 2 up to npow.
+    mass_flux_spatial_ns=None,
+    # If set (with mass_flux_spatial_ns), use overlapping subdomains starting at every grid cell.
+    mass_flux_spatial_sliding=False,
+    # If set, profile_analysis counts clouds on each level in parallel using this many processes.
+    profile_num_processes=None,
+    # If set, process each pp2 file in chunks of this many time indices to bound memory use.
+    profile_time_chunk=None,
+    # If set, restart_dump_summary_info summarises dumps in parallel using this many processes.
+    restart_dump_num_processes=None,
+    # Cache restart_dump_summary_info results for each dump, so only new/changed dumps are rerun.
+    # N.B. the cache (<output>.cache.pkl) is not an omnium output: delete it to force a rerun.
+    restart_dump_use_cache=False,
+    # If set, restart_dump_analysis only keeps MSE profiles (and totals), not full 3D MSE cubes.
+    restart_dump_mse_profile_only=False,
+    # restart_dump_analysis sanity checks: 'off', 'sampled' (random columns) or 'full'.
+    restart_dump_validation='full',
+    restart_dump_validation_columns=1000,
     # mass_flux_spatial_scales_analysis
     npow=4,
     # profile_analysis
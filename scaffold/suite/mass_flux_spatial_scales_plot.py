@@ -11,7 +11,10 @@ from omnium import Analyser
 from scaffold.utils import cm_to_inch
 
 class MassFluxSpatialScalesPlotter(Analyser):
-    """Plots histograms of mass flux for each power of 2 (n), and expt."""
+    """Plots histograms of mass flux for each n x n subdomains, and expt.
+
+    Histograms are rescaled by the number of values for each time: n**2, or the number of grid
+    cells if sliding subdomains were used."""
     analysis_name = 'mass_flux_spatial_scales_plot'
     multi_expt = True
 
@@ -76,6 +79,7 @@ class MassFluxSpatialScalesPlotter(Analyser):
                 # assert len(hist_data) == 3
                 for mf_key, hist_datum in hist_data:
                     (height_index, thresh_index, n) = mf_key
+                    num_values = hist_datum.attributes.get('mass_flux_spatial_num_values', n**2)
                     if n not in ns:
                         ns.append(n)
                     name = '{}.z{}.n{}.hist'.format(expt, height_index, n)
@@ -98,7 +102,7 @@ class MassFluxSpatialScalesPlotter(Analyser):
 
                     # N.B. full width bins.
                     width = bin_edges[1:] - bin_edges[:-1]
-                    plt.bar(bin_centers, y / n**2, width=width)
+                    plt.bar(bin_centers, y / num_values, width=width)
 
                     if self.xlim:
                         plt.xlim(self.xlim)
@@ -108,10 +112,10 @@ class MassFluxSpatialScalesPlotter(Analyser):
 
                     name = '{}.z{}.all_n.hist'.format(expt, height_index)
                     plt.figure(name)
-                    plt.plot(bin_centers, y / n**2, label=n)
+                    plt.plot(bin_centers, y / num_values, label=n)
 
                     plt.figure('combined_expt_z{}_n{}'.format(height_index, n))
-                    plt.plot(bin_centers, y / n**2, label=expt)
+                    plt.plot(bin_centers, y / num_values, label=expt)
 
                     both_name = 'both_z{}'.format(height_index)
                     if plt.fignum_exists(both_name):
@@ -141,12 +145,12 @@ class MassFluxSpatialScalesPlotter(Analyser):
                               2: 'b--',
                               4: 'b-.'}
                     if expt == 'S0' and n <= 4:
-                        style = styles[n]
-                        ax1.plot(bin_centers, y / n**2, style, label=n)
-                        ax1_p.plot(bin_centers, y / n**2, style, label=n)
+                        style = styles.get(n, 'b:')
+                        ax1.plot(bin_centers, y / num_values, style, label=n)
+                        ax1_p.plot(bin_centers, y / num_values, style, label=n)
                     if n == 1:
-                        ax2.plot(bin_centers, y / n**2, label=expt)
-                        ax2_p.plot(bin_centers, y / n**2, label=expt)
+                        ax2.plot(bin_centers, y / num_values, label=expt)
+                        ax2_p.plot(bin_centers, y / num_values, label=expt)
 
         for height_index in heights:
             f = plt.figure('both_z{}'.format(height_index))
@@ -24,6 +24,7 @@ class OrgPlotter(Analyser):
     Calcs and plots a 'histogram' of cloud-cloud distances.
     Uses cloud-cloud distances, divided by area of annulus for each bin, and normalalizes by the
     area avg cloud density (to get a value that would be 1 if cloud field randomly distributed.
+    If org_combined has distance histograms (dist_hist_...), uses their counts and bins directly.
     """
     analysis_name = 'org_plot'
     multi_expt = True
@@ -53,7 +54,10 @@ class OrgPlotter(Analyser):
             lx = expt_obj.lx
 
             for cube in cubes:
-                (height_level_index, thresh_index) = cube.attributes['dist_key']
+                if 'dist_hist_key' in cube.attributes:
+                    (height_level_index, thresh_index) = cube.attributes['dist_hist_key']
+                else:
+                    (height_level_index, thresh_index) = cube.attributes['dist_key']
                 dist_key = (height_level_index, thresh_index)
                 sorted_cubes.append((dist_key, cube))
 
@@ -70,21 +74,29 @@ class OrgPlotter(Analyser):
                 for i, item in enumerate(cubes):
                     cube = item[1]
                     hist_data.append(cube)
-                    dmax = max(cube.data.max(), dmax)
+                    if 'dist_hist_key' not in cube.attributes:
+                        dmax = max(cube.data.max(), dmax)
 
                 assert len(hist_data) == 3
 
-                hist_kwargs = {}
-                if self.xlim:
-                    hist_kwargs['range'] = self.xlim
+                if 'dist_hist_key' in hist_data[self.thresh].attributes:
+                    # Already binned: counts for each distance bin.
+                    dist_hist_cube = hist_data[self.thresh]
+                    n = dist_hist_cube.data
+                    bounds = dist_hist_cube.coord('distance').bounds
+                    bins = np.append(bounds[:, 0], bounds[-1, 1])
                 else:
-                    hist_kwargs['range'] = (0, dmax)
+                    hist_kwargs = {}
+                    if self.xlim:
+                        hist_kwargs['range'] = self.xlim
+                    else:
+                        hist_kwargs['range'] = (0, dmax)
 
-                if self.nbins:
-                    hist_kwargs['bins'] = self.nbins
+                    if self.nbins:
+                        hist_kwargs['bins'] = self.nbins
 
-                plt.figure('Not_used')
-                n, bins, patch = plt.hist(hist_data[self.thresh].data, **hist_kwargs)
+                    plt.figure('Not_used')
+                    n, bins, patch = plt.hist(hist_data[self.thresh].data, **hist_kwargs)
                 plt.figure('combined_expt_z{}'.format(group))
 
                 areas = np.pi * (bins[1:]**2 - bins[:-1]**2)
@@ -92,6 +104,8 @@ class OrgPlotter(Analyser):
 
                 # Correct way to normalize:
                 # Divide the total number in a circle by the circle's area.
+                # N.B. distances can have been cut off (org_dist_cutoff) - need them past lx / 2.
+                assert bins[-1] > lx / 2, 'Need distances out past lx / 2 to normalize'
                 imax = np.argmax(bins[1:] > (lx / 2))
                 mean_density = n[:imax].sum() / (np.pi * bins[imax]**2)
                 xpoints = (bins[:-1] + bins[1:]) / 2
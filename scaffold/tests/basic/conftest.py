@@ -0,0 +1,78 @@
+from mock import Mock
+
+import iris
+import numpy as np
+import pytest
+from iris.fileformats.pp import STASH
+
+from omnium import AnalysisSettings
+from omnium.setup_logging import setup_logger
+
+
+def _make_cube(data, section, item, var_name, heights):
+    time = iris.coords.DimCoord(np.arange(data.shape[0]) * 3600., standard_name='time',
+                                units='seconds since 2000-01-01')
+    forecast_period = iris.coords.AuxCoord(np.arange(data.shape[0]) + 1.,
+                                           standard_name='forecast_period', units='hours')
+    model_level_number = iris.coords.DimCoord(np.arange(len(heights)) + 1,
+                                              standard_name='model_level_number')
+    level_height = iris.coords.AuxCoord(heights, long_name='level_height', units='m')
+    lat = iris.coords.DimCoord(np.arange(data.shape[2]) * 1000., long_name='grid_latitude',
+                               units='m')
+    lon = iris.coords.DimCoord(np.arange(data.shape[3]) * 1000., long_name='grid_longitude',
+                               units='m')
+    cube = iris.cube.Cube(data, var_name=var_name, units='1',
+                          dim_coords_and_dims=[(time, 0), (model_level_number, 1),
+                                               (lat, 2), (lon, 3)],
+                          aux_coords_and_dims=[(forecast_period, 0), (level_height, 1)])
+    cube.attributes['STASH'] = STASH(1, section, item)
+    return cube
+
+
+@pytest.fixture
+def make_cube():
+    """Factory: make_cube(data, section, item, var_name, heights) makes a (time,
+    model_level_number, grid_latitude, grid_longitude) cube like the ones in the UM output."""
+    return _make_cube
+
+
+@pytest.fixture
+def make_input_file(tmpdir):
+    """Factory: make_input_file(basename, fields) saves one cube per field to tmpdir/basename.
+
+    fields is a list of (section, item, var_name, heights, make_data), where
+    make_data(rng, shape) returns the field's data. Data is reproducible. Returns the filename.
+    """
+    def make_input_file(basename, fields, num_times=5, ny=16, nx=16):
+        rng = np.random.RandomState(12345)
+        cubes = []
+        for section, item, var_name, heights, make_data in fields:
+            data = make_data(rng, (num_times, len(heights), ny, nx)).astype(np.float32)
+            cubes.append(_make_cube(data, section, item, var_name, heights))
+        filename = str(tmpdir.join(basename))
+        iris.save(cubes, filename)
+        return filename
+    return make_input_file
+
+
+@pytest.fixture
+def run_analyser(tmpdir):
+    """Factory: run_analyser(analyser_class, input_filename, output_dir, output_basenames,
+    **settings) loads and runs an analyser with mock suite/task, writing to tmpdir/output_dir.
+    """
+    def run_analyser(analyser_class, input_filename, output_dir, output_basenames, **settings):
+        # N.B. omnium debug logs use {}-style args, which pytest's log capturing cannot format.
+        setup_logger(debug=False, colour=False)
+        suite = Mock()
+        suite.check_filename_missing.return_value = False
+        task = Mock()
+        task.runid = 0
+        task.expt = 'expt'
+        task.filenames = [input_filename]
+        output_dir = tmpdir.ensure(output_dir, dir=True)
+        task.output_filenames = [str(output_dir.join(basename)) for basename in output_basenames]
+        analyser = analyser_class(suite, task, AnalysisSettings(settings))
+        analyser.load()
+        analyser.run()
+        return analyser
+    return run_analyser
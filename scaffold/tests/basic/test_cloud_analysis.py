@@ -0,0 +1,151 @@
+import os
+
+from mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from omnium import OmniumError
+
+from scaffold.cloud_utils import cloud_mask_thresh_pairs, cloud_properties
+from scaffold.expt.cloud_analysis import CloudAnalyser
+from scaffold.expt.mass_flux_analysis import MassFluxAnalyser
+from scaffold.expt.org_analysis import OrgAnalyser
+from scaffold.utils import interp_vert_rho2w
+
+NUM_LEVELS = 6
+W_HEIGHTS = (np.arange(NUM_LEVELS) + 1) * 100.
+RHO_HEIGHTS = np.arange(NUM_LEVELS) * 100. + 50
+PP1_FIELDS = [(0, 150, 'w', W_HEIGHTS, lambda rng, shape: rng.normal(size=shape)),
+              (0, 254, 'qcl', W_HEIGHTS, lambda rng, shape: rng.uniform(0, 2e-4, size=shape)),
+              (0, 253, 'rho', RHO_HEIGHTS,
+               lambda rng, shape: rng.uniform(0.5, 1.2, size=shape) * 6371229.**2)]
+SETTINGS = dict(height_levels=[1, 3],
+                w_threshs=[0.5, 1.],
+                qcl_threshs=[5e-5, 1e-4],
+                threshold_pairs=None)
+OUTPUT_BASENAMES = ['atmos.000.cloud_analysis.nc', 'atmos.000.cloud_catalogue.hdf']
+
+
+def _vertlevs():
+    vertlevs = Mock()
+    # Level number 1 is the first theta level: rho levels are the ones below/above it.
+    vertlevs.z_theta = np.append(0, W_HEIGHTS)
+    vertlevs.z_rho = RHO_HEIGHTS
+    return vertlevs
+
+
+def _run_cloud_analysis(run_analyser, input_filename, time_chunk):
+    with patch('scaffold.expt.cloud_analysis.VertLev', return_value=_vertlevs()):
+        return run_analyser(CloudAnalyser, input_filename, 'chunk_{}'.format(time_chunk),
+                            OUTPUT_BASENAMES, cloud_analysis_time_chunk=time_chunk, **SETTINGS)
+
+
+def test_cloud_analysis_time_chunks(tmpdir, make_input_file, run_analyser):
+    input_filename = make_input_file('atmos.000.pp1.nc', PP1_FIELDS)
+
+    unchunked = _run_cloud_analysis(run_analyser, input_filename, None)
+    chunked = _run_cloud_analysis(run_analyser, input_filename, 2)
+    # Chunk files are in a temporary dir next to the output.
+    output_dir = tmpdir.join('chunk_2')
+    assert [p.basename for p in output_dir.listdir()] == [os.path.basename(chunked.chunk_dir)]
+
+    assert list(chunked.results.keys()) == list(unchunked.results.keys())
+    for cube_id, cube in unchunked.results.items():
+        chunked_cube = chunked.results[cube_id]
+        assert chunked_cube.shape == cube.shape
+        assert (chunked_cube.coord('time').points == cube.coord('time').points).all()
+        assert (chunked_cube.data == cube.data).all()
+        if 'heights' in cube.attributes:
+            assert (chunked_cube.attributes['heights'] == cube.attributes['heights']).all()
+
+    chunked.save(None, None)
+    assert chunked.chunk_dir is None
+    assert sorted(p.basename for p in output_dir.listdir()) == ['atmos.000.cloud_analysis.nc',
+                                                                'atmos.000.cloud_catalogue.hdf']
+
+    columns = ['time_index', 'level_number', 'thresh_index', 'cloud_index']
+    catalogues = []
+    for analyser in [unchunked, chunked]:
+        catalogue = pd.concat(analyser.cloud_catalogues, ignore_index=True)
+        catalogues.append(catalogue.sort_values(columns).reset_index(drop=True))
+    assert len(catalogues[0])
+    pd.testing.assert_frame_equal(catalogues[0], catalogues[1])
+
+
+def test_cloud_catalogue_mass_flux(make_input_file, run_analyser):
+    input_filename = make_input_file('atmos.000.pp1.nc', PP1_FIELDS)
+
+    cloud_analyser = _run_cloud_analysis(run_analyser, input_filename, None)
+    cloud_analyser.save(None, None)
+    catalogue = pd.read_hdf(cloud_analyser.task.output_filenames[1], 'cloud_catalogue')
+
+    results = cloud_analyser.results
+    w_slice = results['w_slice']
+    mf = interp_vert_rho2w(_vertlevs(), w_slice, results['rho_slice']) * w_slice.data
+    cloud_mask_cube = results['cloud_mask']
+    level_numbers = cloud_mask_cube.coord('model_level_number').points
+    thresh_pairs = cloud_mask_thresh_pairs(cloud_mask_cube)
+
+    # Mass flux analysis now reads per-cloud mass fluxes from the catalogue.
+    mass_flux_analyser = run_analyser(MassFluxAnalyser, cloud_analyser.task.output_filenames[0],
+                                      'mass_flux', ['atmos.000.mass_flux_analysis.nc'], **SETTINGS)
+
+    num_cells = w_slice.shape[2] * w_slice.shape[3]
+    for height_level_index, level_number in enumerate(level_numbers):
+        for thresh_index, (w_thresh, qcl_thresh) in enumerate(thresh_pairs):
+            cube_id_suffix = 'z{}_w{}_qcl{}'.format(level_number, w_thresh, qcl_thresh)
+            labelled_clouds = results['labelled_clouds_' + cube_id_suffix].data.astype(int)
+            clouds = catalogue[(catalogue.level_number == level_number) &
+                               (catalogue.thresh_index == thresh_index)]
+            mf_level = mf[:, height_level_index]
+
+            properties = cloud_properties(labelled_clouds, labelled_clouds.max(axis=(1, 2)),
+                                          mf_level, w_slice.data[:, height_level_index])
+            assert len(clouds) == len(properties['area']) > 0
+            assert (clouds['area'].values == properties['area']).all()
+            assert np.allclose(clouds['mass_flux'].values, properties['mass_flux'])
+
+            # Same as working out each cloud's mass flux/area from its cells.
+            mass_fluxes, total_mass_fluxes, sigmas = [], [], []
+            for time_index in range(labelled_clouds.shape[0]):
+                labels = labelled_clouds[time_index]
+                for label in range(1, labels.max() + 1):
+                    mass_fluxes.append(mf_level[time_index][labels == label].sum())
+                total_mass_fluxes.append(mf_level[time_index][labels >= 1].sum())
+                sigmas.append((labels >= 1).sum() / num_cells)
+            areas = [(labelled_clouds[t] == l).sum() for t, l in
+                     zip(clouds['time_index'], clouds['cloud_index'])]
+            assert (clouds['area'].values == areas).all()
+            assert np.allclose(clouds['mass_flux'].values, mass_fluxes)
+
+            mass_flux_results = mass_flux_analyser.results
+            assert np.allclose(mass_flux_results['mass_flux_' + cube_id_suffix].data,
+                               mass_fluxes)
+            assert np.allclose(mass_flux_results['total_mass_flux_' + cube_id_suffix].data,
+                               total_mass_fluxes)
+            assert np.allclose(mass_flux_results['sigma_' + cube_id_suffix].data, sigmas)
+
+
+def test_mass_flux_analysis_no_cloud_catalogue(make_input_file, run_analyser):
+    input_filename = make_input_file('atmos.000.pp1.nc', PP1_FIELDS)
+    cloud_analyser = _run_cloud_analysis(run_analyser, input_filename, None)
+    # Only the .nc output, as written by cloud_analysis before it made a catalogue.
+    cloud_analyser.save_results_cubes(None, None)
+
+    with pytest.raises(OmniumError, match='rerun cloud_analysis'):
+        run_analyser(MassFluxAnalyser, cloud_analyser.task.output_filenames[0], 'mass_flux',
+                     ['atmos.000.mass_flux_analysis.nc'], **SETTINGS)
+
+
+def test_org_analysis_dist_cutoff(make_input_file, run_analyser):
+    input_filename = make_input_file('atmos.000.pp1.nc', PP1_FIELDS)
+    cloud_analyser = _run_cloud_analysis(run_analyser, input_filename, None)
+    cloud_analyser.save_results_cubes(None, None)
+
+    # 16 x 1 km domain: org_plot needs distances out past LX / 2 + bin width = 9 km.
+    with pytest.raises(ValueError, match='org_dist_cutoff'):
+        run_analyser(OrgAnalyser, cloud_analyser.task.output_filenames[0], 'org',
+                     ['atmos.000.org_analysis.nc'], org_dist_cutoff=9000.,
+                     org_dist_hist_bin_width=1000., **SETTINGS)
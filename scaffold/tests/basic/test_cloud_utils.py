@@ -0,0 +1,172 @@
+import numpy as np
+from cloud_tracking.utils import label_clds
+
+from scaffold.cloud_utils import (threshold_clouds, label_clds_batch, cloud_properties,
+                                  cloud_distances, cloud_centroids, count_clds_batch)
+
+
+def _random_w_qcl(shape=(4, 3, 16, 16)):
+    rng = np.random.RandomState(12345)
+    w = rng.normal(size=shape).astype(np.float32)
+    qcl = (rng.normal(size=shape) * 1e-5).astype(np.float32)
+    return w, qcl
+
+
+def test_threshold_clouds():
+    w, qcl = _random_w_qcl()
+    w_threshs = [0.9, 1., 1.1]
+    qcl_threshs = [4.5e-6, 5e-6, 5.5e-6]
+    cloud_mask = threshold_clouds(w, qcl, w_threshs, qcl_threshs)
+    assert cloud_mask.shape == (4, 3, 3, 3, 16, 16)
+    assert cloud_mask.dtype == np.uint8
+
+    for h_index in range(w.shape[1]):
+        for w_index, w_thresh in enumerate(w_threshs):
+            for qcl_index, qcl_thresh in enumerate(qcl_threshs):
+                expected = (w[:, h_index] > w_thresh) & (qcl[:, h_index] > qcl_thresh)
+                assert (cloud_mask[:, h_index, w_index, qcl_index] == expected).all()
+
+
+def test_threshold_clouds_pairs():
+    w, qcl = _random_w_qcl()
+    w_threshs = [0.9, 1., 1.1]
+    qcl_threshs = [4.5e-6, 5e-6, 5.5e-6]
+    cloud_mask = threshold_clouds(w, qcl, w_threshs, qcl_threshs)
+    cloud_mask_pairs = threshold_clouds(w, qcl, w_threshs, qcl_threshs, pairs=True)
+    assert cloud_mask_pairs.shape == (4, 3, 3, 16, 16)
+
+    for thresh_index in range(len(w_threshs)):
+        assert (cloud_mask_pairs[:, :, thresh_index] ==
+                cloud_mask[:, :, thresh_index, thresh_index]).all()
+
+
+def test_label_clds_batch():
+    rng = np.random.RandomState(54321)
+    cld_fields = rng.uniform(size=(6, 32, 32)) < 0.3
+    # Make sure an empty slice is handled.
+    cld_fields[2] = False
+
+    num_clds, labelled_clouds = label_clds_batch(cld_fields, diagonal=True)
+    assert labelled_clouds.shape == cld_fields.shape
+    for time_index in range(cld_fields.shape[0]):
+        max_cld_index, expected = label_clds(cld_fields[time_index], diagonal=True)
+        assert num_clds[time_index] == max_cld_index
+        assert (labelled_clouds[time_index] == expected).all()
+
+    assert (count_clds_batch(cld_fields, diagonal=True) == num_clds).all()
+
+
+def test_label_clds_batch_no_slices():
+    # e.g. an empty time chunk.
+    cld_fields = np.zeros((0, 32, 32), dtype=bool)
+    num_clds, labelled_clouds = label_clds_batch(cld_fields, diagonal=True)
+    assert num_clds.shape == (0,)
+    assert labelled_clouds.shape == cld_fields.shape
+    assert labelled_clouds.dtype == label_clds_batch(np.ones((1, 32, 32), dtype=bool))[1].dtype
+    assert count_clds_batch(cld_fields, diagonal=True).shape == (0,)
+
+
+def test_label_clds_batch_wrap():
+    cld_field = np.zeros((1, 8, 8), dtype=bool)
+    # Joined diagonally across the corner.
+    cld_field[0, 0, 0] = cld_field[0, 7, 7] = True
+    # Joined across the lat boundary.
+    cld_field[0, 0, 4] = cld_field[0, 7, 4] = True
+    # Joined across the lon boundary.
+    cld_field[0, 3, 0] = cld_field[0, 3, 7] = True
+
+    num_clds, labelled_clouds = label_clds_batch(cld_field, diagonal=True)
+    assert num_clds[0] == 3
+    # Numbered in the order they are first found.
+    assert labelled_clouds[0, 0, 0] == labelled_clouds[0, 7, 7] == 1
+    assert labelled_clouds[0, 0, 4] == labelled_clouds[0, 7, 4] == 2
+    assert labelled_clouds[0, 3, 0] == labelled_clouds[0, 3, 7] == 3
+
+    num_clds, labelled_clouds = label_clds_batch(cld_field, diagonal=False)
+    assert num_clds[0] == 4
+    assert count_clds_batch(cld_field, diagonal=True)[0] == 3
+    assert count_clds_batch(cld_field, diagonal=False)[0] == 4
+
+
+def test_cloud_properties():
+    cld_fields = np.zeros((2, 8, 8), dtype=bool)
+    # Crosses the lat boundary.
+    cld_fields[0, 0, 2] = cld_fields[0, 7, 2] = cld_fields[0, 7, 3] = True
+    cld_fields[0, 4, 4] = True
+    cld_fields[1, 2, 5] = cld_fields[1, 2, 6] = True
+    num_clds, labelled_clouds = label_clds_batch(cld_fields, diagonal=True)
+
+    rng = np.random.RandomState(12345)
+    mass_flux = rng.normal(size=cld_fields.shape)
+    w = rng.normal(size=cld_fields.shape)
+    properties = cloud_properties(labelled_clouds, num_clds, mass_flux, w)
+
+    assert list(properties['slice_index']) == [0, 0, 1]
+    assert list(properties['cloud_index']) == [1, 2, 1]
+    assert list(properties['area']) == [3, 1, 2]
+    for cloud, (slice_index, cloud_index) in enumerate(zip(properties['slice_index'],
+                                                           properties['cloud_index'])):
+        mask = labelled_clouds[slice_index] == cloud_index
+        assert np.isclose(properties['mass_flux'][cloud], mass_flux[slice_index][mask].sum())
+        assert properties['max_w'][cloud] == w[slice_index][mask].max()
+
+    assert np.isclose(properties['centroid_i'][0], 22 / 3)
+    assert np.isclose(properties['centroid_j'][0], 7 / 3)
+    assert (properties['bbox_imin'][0], properties['bbox_imax'][0]) == (7, 8)
+    assert (properties['bbox_jmin'][0], properties['bbox_jmax'][0]) == (2, 3)
+    assert np.isclose(properties['centroid_j'][2], 5.5)
+
+
+def test_cloud_distances():
+    LX, LY = 256000., 128000.
+    rng = np.random.RandomState(12345)
+    cloud_pos = rng.uniform(size=(20, 2)) * [LX, LY]
+
+    expected = []
+    for i in range(len(cloud_pos)):
+        for j in range(i + 1, len(cloud_pos)):
+            for ii in [-1, 0, 1]:
+                for jj in [-1, 0, 1]:
+                    x = cloud_pos[j, 0] + ii * LX
+                    y = cloud_pos[j, 1] + jj * LY
+                    expected.append(np.sqrt((cloud_pos[i, 0] - x)**2 + (cloud_pos[i, 1] - y)**2))
+    expected = np.array(expected)
+
+    dists = cloud_distances(cloud_pos, LX, LY)
+    assert dists.shape == expected.shape
+    assert np.allclose(dists, expected, rtol=1e-15, atol=0)
+
+    min_dists = cloud_distances(cloud_pos, LX, LY, min_image=True)
+    assert np.allclose(min_dists, expected.reshape(-1, 9).min(axis=1), rtol=1e-15, atol=0)
+    assert len(cloud_distances(cloud_pos[:1], LX, LY)) == 0
+
+
+def test_cloud_distances_cutoff():
+    LX, LY = 256000., 128000.
+    rng = np.random.RandomState(54321)
+    cloud_pos = rng.uniform(size=(200, 2)) * [LX, LY]
+
+    for min_image in [False, True]:
+        dists = cloud_distances(cloud_pos, LX, LY, min_image=min_image)
+        for cutoff in [20000., 100000., 300000.]:
+            cutoff_dists = cloud_distances(cloud_pos, LX, LY, min_image=min_image, cutoff=cutoff)
+            expected = dists[dists <= cutoff]
+            assert cutoff_dists.shape == expected.shape
+            assert np.allclose(cutoff_dists, expected, rtol=1e-12, atol=0)
+
+
+def test_cloud_centroids():
+    NX, NY = 8, 4
+    LX, LY = 8000., 4000.
+    X, Y = np.meshgrid(np.arange(NX) * 1000. + 500., np.arange(NY) * 1000. + 500.)
+    clouds = np.zeros((NY, NX), dtype=np.uint8)
+    clouds[1, 2:4] = 1
+    # Crosses the lon boundary.
+    clouds[2, 0] = clouds[2, 7] = 2
+
+    cloud_pos = cloud_centroids(clouds, X, Y, LX, LY)
+    assert np.allclose(cloud_pos, [[3000., 1500.], [4000., 2500.]])
+
+    cloud_pos = cloud_centroids(clouds, X, Y, LX, LY, circular=True)
+    assert np.allclose(cloud_pos, [[3000., 1500.], [0., 2500.]]) or \
+        np.allclose(cloud_pos, [[3000., 1500.], [LX, 2500.]])
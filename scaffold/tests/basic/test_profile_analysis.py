@@ -0,0 +1,83 @@
+from mock import Mock, patch
+
+import iris
+import numpy as np
+
+from omnium.utils import get_cube
+
+from scaffold.expt.profile_analysis import ProfileAnalyser, collapsed_cube
+
+NUM_LEVELS = 6
+THETA_HEIGHTS = np.arange(NUM_LEVELS) * 100.
+RHO_HEIGHTS = np.arange(NUM_LEVELS - 1) * 100. + 50
+
+
+def _uniform(low, high):
+    return lambda rng, shape: rng.uniform(low, high, size=shape)
+
+
+PP2_FIELDS = [(0, 2, 'u', RHO_HEIGHTS, _uniform(-5, 5)),
+              (0, 3, 'v', RHO_HEIGHTS, _uniform(-5, 5)),
+              (53, 185, 'u_inc', RHO_HEIGHTS, _uniform(-1e-3, 1e-3)),
+              (53, 186, 'v_inc', RHO_HEIGHTS, _uniform(-1e-3, 1e-3)),
+              (0, 4, 'theta', THETA_HEIGHTS, _uniform(290, 310)),
+              (0, 254, 'qcl', THETA_HEIGHTS, _uniform(0, 2e-4)),
+              (0, 273, 'qgr', THETA_HEIGHTS, _uniform(0, 1e-4)),
+              (0, 12, 'qcf', THETA_HEIGHTS, _uniform(0, 1e-4)),
+              (0, 150, 'w', THETA_HEIGHTS, lambda rng, shape: rng.normal(size=shape)),
+              (0, 253, 'rho', RHO_HEIGHTS, _uniform(0.5 * 6371229.**2, 1.2 * 6371229.**2)),
+              (0, 408, 'pressure', THETA_HEIGHTS,
+               lambda rng, shape: (np.linspace(1e5, 5e3, shape[1])[None, :, None, None] +
+                                   rng.uniform(0, 10, size=shape)))]
+
+
+def _run_profile_analysis(run_analyser, input_filename, time_chunk, num_processes):
+    expts = Mock()
+    expts.get.return_value = Mock(dx=1000., dy=1000.)
+    with patch('scaffold.expt.profile_analysis.ExptList', return_value=expts):
+        return run_analyser(ProfileAnalyser, input_filename,
+                            'chunk_{}_procs_{}'.format(time_chunk, num_processes),
+                            ['atmos.000.profile_analysis.nc'],
+                            w_thresh=0.5, qcl_thresh=5e-5,
+                            profile_time_chunk=time_chunk, profile_num_processes=num_processes)
+
+
+def test_collapsed_cube(make_cube):
+    data = np.random.RandomState(12345).rand(3, 4, 5, 6).astype(np.float32)
+    cube = make_cube(data, 0, 4, 'theta', np.arange(4.))
+    cube.add_aux_coord(iris.coords.AuxCoord(0., standard_name='forecast_reference_time',
+                                            units='hours since 2000-01-01'))
+
+    for collapsed_coords, axis in [(('time', 'grid_latitude', 'grid_longitude'), (0, 2, 3)),
+                                   (('grid_latitude', 'grid_longitude'), (2, 3))]:
+        expected = cube.collapsed(list(collapsed_coords), iris.analysis.MEAN)
+        collapsed = collapsed_cube(cube, data.mean(axis=axis), collapsed_coords)
+        assert collapsed.metadata == expected.metadata
+        # Including forecast_period, which spans the time dim.
+        assert collapsed.coords() == expected.coords()
+        assert np.allclose(collapsed.data, expected.data)
+
+
+def test_profile_analysis_time_chunks(make_input_file, run_analyser):
+    input_filename = make_input_file('atmos.000.pp2.nc', PP2_FIELDS)
+
+    all_times = _run_profile_analysis(run_analyser, input_filename, None, None)
+    for time_chunk, num_processes in [(None, 2), (2, None), (2, 2)]:
+        analyser = _run_profile_analysis(run_analyser, input_filename, time_chunk, num_processes)
+        assert list(analyser.results.keys()) == list(all_times.results.keys())
+        for name, cube in all_times.results.items():
+            assert analyser.results[name].shape == cube.shape
+            assert np.allclose(analyser.results[name].data, cube.data, equal_nan=True)
+
+    # Mass flux profile from the full w, qcl and rho arrays.
+    cubes = iris.load(input_filename)
+    w, qcl, rho = [get_cube(cubes, 0, item).data for item in [150, 254, 253]]
+    w_rho_grid = (w[:, :-1] + w[:, 1:]) / 2
+    qcl_rho_grid = (qcl[:, :-1] + qcl[:, 1:]) / 2
+    mask = (w_rho_grid > 0.5) & (qcl_rho_grid > 5e-5)
+    mf = w_rho_grid * rho / 6371229.**2
+    mf_conv = np.where(mask, mf, 0).sum(axis=(0, 2, 3))
+    num_clouds = all_times.results['clouds_cloud_profile'].data
+    assert (num_clouds > 0).all()
+    assert np.allclose(all_times.results['mf_cloud_profile'].data,
+                       mf_conv / num_clouds * 1000. * 1000.)
@@ -0,0 +1,45 @@
+import iris
+import numpy as np
+from iris.cube import Cube
+
+from omnium.consts import L, cp, g
+
+from scaffold.expt.restart_dump_analysis import column_data, mse_terms
+
+
+def test_mse_terms_mixed_dtypes():
+    rng = np.random.RandomState(12345)
+    shape = (4, 5, 6)
+    rho = rng.uniform(0.5, 1.2, size=(shape[0] - 1,) + shape[1:])
+    th = rng.uniform(290, 310, size=shape).astype(np.float32)
+    ep = rng.uniform(0.9, 1., size=shape).astype(np.float32)
+    q = rng.uniform(0, 2e-2, size=shape).astype(np.float32)
+    rho_heights = np.arange(shape[0] - 1) * 100. + 50
+
+    # float64 rho with float32 theta, ep and q gives float64 terms, as the full expressions do.
+    for rho_data, dtype in [(rho, np.float64), (rho.astype(np.float32), np.float32)]:
+        e_t, e_q, e_z = mse_terms(rho_data, th, ep, q, rho_heights)
+        assert e_t.dtype == e_q.dtype == dtype
+
+        expected_e_t = rho_data * (th[:-1] + th[1:]) / 2 * ep[:-1] * cp
+        expected_e_q = rho_data * (q[:-1] + q[1:]) / 2 * L
+        expected_e_z = rho_data * g * rho_heights[:, None, None]
+        for term, expected in [(e_t, expected_e_t), (e_q, expected_e_q), (e_z, expected_e_z)]:
+            assert term.dtype == expected.dtype
+            assert np.allclose(term, expected, rtol=1e-6)
+
+
+def test_column_data(tmpdir):
+    data = np.random.RandomState(12345).rand(4, 40, 50).astype(np.float32)
+    filename = str(tmpdir.join('cube.nc'))
+    iris.save(Cube(data, var_name='q'), filename)
+    cube = iris.load_cube(filename)
+    columns = np.unravel_index([0, 77, 1999], (40, 50))
+
+    assert cube.has_lazy_data()
+    column_datum = column_data(cube, columns)
+    # Only the columns have been read, not the whole of cube's data.
+    assert cube.has_lazy_data()
+    assert column_datum.shape == (4, 3)
+    assert (column_datum == data[(slice(None),) + columns]).all()
+    assert (column_data(cube) == data).all()
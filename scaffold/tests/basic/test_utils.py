@@ -0,0 +1,89 @@
+import numpy as np
+
+from scaffold.utils import (coarse_grain_pyramid, window_sums, max_wind_diff_between_levels,
+                            wind_shear_between_levels)
+
+
+def test_coarse_grain_pyramid():
+    rng = np.random.RandomState(12345)
+    data = rng.normal(size=(2, 32, 32))
+    mask = rng.uniform(size=data.shape) < 0.3
+
+    coarse_data = coarse_grain_pyramid(data, mask, 4)
+    assert [n for n, _ in coarse_data] == [1, 2, 4, 8]
+    for n, coarse in coarse_data:
+        assert coarse.shape == (2, n, n)
+        l = 32 // n
+        for i in range(n):
+            for j in range(n):
+                s1 = slice(i * l, (i + 1) * l)
+                s2 = slice(j * l, (j + 1) * l)
+                for k in range(2):
+                    expected = data[k, s1, s2][mask[k, s1, s2]].sum()
+                    assert np.isclose(coarse[k, i, j], expected)
+
+
+def test_window_sums():
+    rng = np.random.RandomState(54321)
+    data = rng.normal(size=(2, 12, 12))
+    mask = rng.uniform(size=data.shape) < 0.3
+
+    for window, sums in window_sums(data, mask, [3, 4, 6]):
+        assert sums.shape == (2, 12 // window, 12 // window)
+        conv_data = np.where(mask, data, 0)
+        expected = conv_data.reshape(2, 12 // window, window, 12 // window, window).sum(axis=(2, 4))
+        assert np.allclose(sums, expected)
+
+    for window, sums in window_sums(data, mask, [5], sliding=True):
+        assert sums.shape == data.shape
+        for i, j in [(0, 0), (3, 9), (11, 11)]:
+            rows = np.arange(i, i + window) % 12
+            cols = np.arange(j, j + window) % 12
+            conv_data = np.where(mask, data, 0)
+            assert np.allclose(sums[:, i, j], conv_data[:, rows][:, :, cols].sum(axis=(1, 2)))
+
+
+def _loop_max_wind_diff(u_profile, v_profile, start_level, end_level):
+    max_wind_diff, max_i, max_j = 0, 0, 0
+    for i in range(start_level, end_level - 1):
+        for j in range(i + 1, end_level):
+            wind_diff = np.sqrt((u_profile[i] - u_profile[j])**2 +
+                                (v_profile[i] - v_profile[j])**2)
+            if wind_diff > max_wind_diff:
+                max_wind_diff = wind_diff
+                max_i, max_j = i, j
+    return max_wind_diff, max_i, max_j
+
+
+def test_max_wind_diff_between_levels():
+    rng = np.random.RandomState(2468)
+    u_profiles = rng.normal(size=(5, 40))
+    v_profiles = rng.normal(size=(5, 40))
+    # Ties: first pair in (i, j) order wins.
+    u_profiles[1] = 0
+    v_profiles[1] = 0
+    u_profiles[1, [3, 5]] = 1
+    # No wind diff at all.
+    u_profiles[2] = 1
+    v_profiles[2] = 0
+
+    for start_level, end_level in [(0, 17), (17, 33), (5, 6)]:
+        max_wind_diff, max_i, max_j = max_wind_diff_between_levels(u_profiles, v_profiles,
+                                                                   start_level, end_level)
+        assert max_wind_diff.shape == max_i.shape == max_j.shape == (5,)
+        for k in range(5):
+            expected = _loop_max_wind_diff(u_profiles[k], v_profiles[k], start_level, end_level)
+            single = max_wind_diff_between_levels(u_profiles[k], v_profiles[k],
+                                                  start_level, end_level)
+            for result in [(max_wind_diff[k], max_i[k], max_j[k]), single]:
+                assert np.isclose(result[0], expected[0], rtol=1e-15, atol=0)
+                assert result[1:] == expected[1:]
+
+    assert max_wind_diff_between_levels(u_profiles[1], v_profiles[1], 0, 17) == (1, 0, 3)
+    assert max_wind_diff_between_levels(u_profiles[2], v_profiles[2], 0, 17) == (0, 0, 0)
+
+    z = np.arange(40) * 100.
+    max_wind_diff, max_i, max_j, shear = wind_shear_between_levels(u_profiles[[0, 3, 4]],
+                                                                   v_profiles[[0, 3, 4]],
+                                                                   z, 0, 17)
+    assert np.allclose(shear, max_wind_diff / ((max_j - max_i) * 100.))
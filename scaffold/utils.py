@@ -15,31 +15,155 @@ def find_intersections(c1, c2):
     return indices, weights
 
 
-def interp_vert_rho2w(vertlevs, w_slice, rho_slice, time_index, height_level_index,
-                      level_number):
-    """Interpolate vertically from rho to w. Perform checks to make sure interp. is good. """
+def interp_vert_rho2w(vertlevs, w_slice, rho_slice):
+    """Interpolate vertically from rho to w for all times and heights in one go.
+
+    Perform checks to make sure interp. is good - once for all heights.
+    Returns array with the same shape as w_slice: (time, height, lat, lon).
+    """
+    level_numbers = w_slice.coord('model_level_number').points
 
     # Work out in 2 ways and check equal because paranoid.
     # AKA sanity checks.
-    w_height = w_slice.attributes['heights'][height_level_index]
-    w_height2 = vertlevs.z_theta[level_number]
+    w_heights = np.asarray(w_slice.attributes['heights'])
+    w_heights2 = vertlevs.z_theta[level_numbers]
     # N.B. for every 1 w_height, there are 2 rho_heights. Index appropriately.
-    rho_height_lower = rho_slice.attributes['heights'][2 * height_level_index]
-    rho_height_lower2 = vertlevs.z_rho[level_number - 1]
-    rho_height_upper = rho_slice.attributes['heights'][2 * height_level_index + 1]
-    rho_height_upper2 = vertlevs.z_rho[level_number]
+    rho_heights = np.asarray(rho_slice.attributes['heights'])
+    rho_heights_lower = rho_heights[0::2]
+    rho_heights_lower2 = vertlevs.z_rho[level_numbers - 1]
+    rho_heights_upper = rho_heights[1::2]
+    rho_heights_upper2 = vertlevs.z_rho[level_numbers]
     # Calc scaling for linear interp.
-    alpha = (w_height - rho_height_lower) / (rho_height_upper - rho_height_lower)
+    alphas = (w_heights - rho_heights_lower) / (rho_heights_upper - rho_heights_lower)
 
     # Paranoia. Well justified it turns out. Saved me from doing wrong analysis.
-    assert w_height == w_height2
-    assert rho_height_lower == rho_height_lower2
-    assert rho_height_upper == rho_height_upper2
-    assert 0 <= alpha <= 1
+    assert (w_heights == w_heights2).all()
+    assert (rho_heights_lower == rho_heights_lower2).all()
+    assert (rho_heights_upper == rho_heights_upper2).all()
+    assert ((0 <= alphas) & (alphas <= 1)).all()
 
     # Interp rho onto w grid.
-    rho_ss_lower = rho_slice[time_index, height_level_index].data
-    rho_ss_upper = rho_slice[time_index, height_level_index + 1].data
+    rho = rho_slice.data
+    rho_lower = rho[:, 0::2]
+    rho_upper = rho[:, 1::2]
+    assert rho_lower.shape == w_slice.shape
+
+    # Broadcast over (time, height, lat, lon), keeping rho's dtype.
+    lower_weights = (1 - alphas).astype(rho.dtype)[None, :, None, None]
+    upper_weights = alphas.astype(rho.dtype)[None, :, None, None]
+    rho_interp = lower_weights * rho_lower + upper_weights * rho_upper
+    return rho_interp
+
+
+def coarse_grain_pyramid(data, mask, npow):
+    """Sum data where mask is True over subdomains, for n x n subdomains with n = 1, 2, 4, ...
+
+    Same n and output as omnium.utils.coarse_grain (n in 2**np.arange(npow)), but data and mask
+    can have any leading dims: (..., ny, nx), and all n are worked out in one pyramid. The finest
+    subdomain sums are found with one reshape and sum, then each coarser n is found by summing
+    2 x 2 blocks of the next finer n. Sums are done in float64.
+
+    Returns a list of (n, coarse), where coarse has shape (..., n, n).
+    """
+    assert data.shape == mask.shape
+    ny, nx = data.shape[-2:]
+    ns = 2**np.arange(npow)
+    n_max = ns[-1]
+    assert ny % n_max == 0 and nx % n_max == 0
+
+    lead_shape = data.shape[:-2]
+    conv_data = np.where(mask, data, 0).astype(np.float64)
+    block_shape = (n_max, ny // n_max, n_max, nx // n_max)
+    coarse = conv_data.reshape(lead_shape + block_shape).sum(axis=(-3, -1))
+
+    coarse_data = [(n_max, coarse)]
+    for n in ns[-2::-1]:
+        coarse = coarse.reshape(lead_shape + (n, 2, n, 2)).sum(axis=(-3, -1))
+        coarse_data.append((n, coarse))
+    return coarse_data[::-1]
+
+
+def window_sums(data, mask, windows, sliding=False):
+    """Sum data where mask is True over window x window subdomains, for each window in windows.
+
+    Uses one summed-area table (integral image) of the (periodically wrapped) data, after which
+    each subdomain sum costs O(1), so any window sizes can be used, not just powers of 2.
+    data and mask can have any leading dims: (..., ny, nx). If sliding, there is one (overlapping)
+    subdomain starting at every grid cell, wrapping round the bicyclic domain. Otherwise the
+    subdomains tile the domain, so window must divide ny and nx. Sums are done in float64.
+
+    Returns a list of (window, sums), where sums has shape (..., ny, nx) if sliding, otherwise
+    (..., ny // window, nx // window).
+    """
+    assert data.shape == mask.shape
+    ny, nx = data.shape[-2:]
+    max_window = max(windows)
+    assert max_window <= min(ny, nx)
+
+    conv_data = np.where(mask, data, 0).astype(np.float64)
+    # Wrap the data so that sliding windows can cross the boundary.
+    pad_width = [(0, 0)] * (conv_data.ndim - 2) + [(0, max_window - 1), (0, max_window - 1)]
+    conv_data = np.pad(conv_data, pad_width, mode='wrap')
+    # sat[..., i, j] is the sum of conv_data[..., :i, :j].
+    sat = np.zeros(conv_data.shape[:-2] + (conv_data.shape[-2] + 1, conv_data.shape[-1] + 1))
+    sat[..., 1:, 1:] = conv_data.cumsum(axis=-2).cumsum(axis=-1)
+
+    window_data = []
+    for window in windows:
+        if sliding:
+            stride = 1
+        else:
+            assert ny % window == 0 and nx % window == 0
+            stride = window
+        i = np.arange(0, ny, stride)[:, None]
+        j = np.arange(0, nx, stride)[None, :]
+        sums = (sat[..., i + window, j + window] - sat[..., i, j + window] -
+                sat[..., i + window, j] + sat[..., i, j])
+        window_data.append((window, sums))
+    return window_data
+
+
+def max_wind_diff_between_levels(u_profile, v_profile, start_level, end_level):
+    """Max wind difference between any two levels i < j in range(start_level, end_level).
+
+    Works out the wind diff for every pair of levels in one go. Profiles can be stacked,
+    e.g. (dump, level), in which case the max for each profile is returned as an array.
+    Ties go to the first pair in (i, j) order. If no diff is greater than 0, returns 0, 0, 0.
+    N.B. i is lower (higher pressure).
+
+    Returns max_wind_diff, max_i, max_j.
+    """
+    u_profile = np.asarray(u_profile)
+    v_profile = np.asarray(v_profile)
+    lead_shape = u_profile.shape[:-1]
+    # Pairs are in the same order as looping over i then j.
+    i, j = np.triu_indices(max(end_level - start_level, 0), 1)
+    i += start_level
+    j += start_level
+    if not len(i):
+        zeros = np.zeros(lead_shape, dtype=int)
+        return zeros[()], zeros[()], zeros[()]
+
+    wind_diffs = np.sqrt((u_profile[..., i] - u_profile[..., j])**2 +
+                         (v_profile[..., i] - v_profile[..., j])**2)
+    # N.B. also maps any NaNs to 0, so they never count as the max.
+    wind_diffs = np.where(wind_diffs > 0, wind_diffs, 0)
+    max_index = wind_diffs.argmax(axis=-1)
+    max_wind_diff = wind_diffs.max(axis=-1)
+    found = max_wind_diff > 0
+    max_i = np.where(found, i[max_index], 0)
+    max_j = np.where(found, j[max_index], 0)
+    return max_wind_diff[()], max_i[()], max_j[()]
+
+
+def wind_shear_between_levels(u_profile, v_profile, z, start_level, end_level):
+    """Max wind diff between levels, as in max_wind_diff_between_levels, and the shear over it.
+
+    z are the heights of the levels (shared by all profiles).
 
-    rho_ss_interp = (1 - alpha) * rho_ss_lower + alpha * rho_ss_upper
-    return rho_ss_interp
+    Returns max_wind_diff, max_i, max_j, shear.
+    """
+    z = np.asarray(z)
+    max_wind_diff, max_i, max_j = max_wind_diff_between_levels(u_profile, v_profile,
+                                                               start_level, end_level)
+    return max_wind_diff, max_i, max_j, max_wind_diff / (z[max_j] - z[max_i])
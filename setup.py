@@ -40,6 +40,7 @@ setup(
         'f90nml',
         'iris',
         'matplotlib',
+        'netCDF4',
         'numpy',
         'scipy',
     ],